@@ -28,13 +28,13 @@ import tempfile
 from tempfile import TemporaryDirectory
 
 # GUI imports
-from gi.repository import Gtk, Gdk, Gio, GObject
+from gi.repository import Gtk, Gdk, Gio, GLib, GObject
 import cairo
 from gettext import gettext as _
 
 # Package imports
 from . import extending, notifying, utility, widgets, mousing, preferences
-from . import viewing, organizing, loading, opening
+from . import caching, viewing, organizing, loading, opening
 from .viewing import ZoomMode
 
 # Components imports
@@ -44,6 +44,8 @@ components.import_addons()
 
 DND_URI_LIST, DND_IMAGE = range(2)
 CACHE_DIRECTORY_PREFIX = "pynorama-cache-"
+# How many of the sources being opened are logged
+LOGGED_SOURCE_LIMIT = 100
 
 # Log stuff
 uilogger = notifying.Logger("interface")
@@ -111,6 +113,12 @@ class ImageViewer(Gtk.Application):
         self.memory.connect("thing-requested", self.queue_memory_check)
         self.memory.connect("thing-unused", self.queue_memory_check)
         self.memory.connect("thing-unlisted", self.queue_memory_check)
+        self.memory.connect("notify::budget", self.queue_memory_check)
+        self.memory.connect("prefetch-changed", self.queue_memory_check)
+        
+        # The memory budget is shared by all windows
+        self.connect("notify::memory-budget", self._memory_budget_changed_cb)
+        self._memory_budget_changed_cb()
         
         # Create base directory for cache
         self.cache_directory = TemporaryDirectory("", CACHE_DIRECTORY_PREFIX)
@@ -135,6 +143,7 @@ class ImageViewer(Gtk.Application):
     
     def do_shutdown(self):
         preferences.SaveFromApp(self)
+        caching.DownloadedFiles.commit()
         self.cache_directory.cleanup()
         Gtk.Application.do_shutdown(self)
     
@@ -142,6 +151,11 @@ class ImageViewer(Gtk.Application):
     #-- Some properties down this line --#
     zoom_effect = GObject.Property(type=float, default=1.25)
     spin_effect = GObject.Property(type=float, default=90)
+    # How many MiB loaded images can take before unused ones are unloaded
+    memory_budget = GObject.Property(
+        type=int, minimum=0, maximum=1024 * 1024,
+        default=loading.DEFAULT_MEMORY_BUDGET // (1024 * 1024)
+    )
     
     def show_open_image_dialog(self,
             open_cb,
@@ -401,28 +415,58 @@ class ImageViewer(Gtk.Application):
         while self.memory.enlisted_stuff:
             enlisted_thing = self.memory.enlisted_stuff.pop()
             enlisted_thing.connect("finished-loading", self.log_loading_finish)
-        
-        if self.memory.unlisted_stuff or self.memory.unused_stuff:
-            while self.memory.unlisted_stuff:
-                unlisted_thing = self.memory.unlisted_stuff.pop()
-                unlisted_thing.destroy()
-                logger.debug(notifying.Lines.Unloaded(unlisted_thing))
-            
-            while self.memory.unused_stuff:
-                unused_thing = self.memory.unused_stuff.pop()
-                # Do not unload things that are not on disk (like pastes)
-                if unused_thing.reloadable:
-                    if unused_thing.status & loading.Status.LOADED != 0:
-                        unused_thing.unload()
-                        logger.debug(notifying.Lines.Unloaded(unused_thing))
-            
+            # Something loaded might not fit the memory budget
+            enlisted_thing.connect("finished-loading", self.queue_memory_check)
+        
+        unloaded_anything = False
+        while self.memory.unlisted_stuff:
+            unlisted_thing = self.memory.unlisted_stuff.pop()
+            self.memory.release(unlisted_thing)
+            unlisted_thing.destroy()
+            logger.debug(notifying.Lines.Unloaded(unlisted_thing))
+            unloaded_anything = True
+        
+        while self.memory.unused_stuff:
+            unused_thing = self.memory.unused_stuff.pop()
+            # Do not unload things that are not on disk (like pastes)
+            if unused_thing.reloadable:
+                if unused_thing.is_loaded:
+                    # Kept in case it's used again soon
+                    self.memory.retain(unused_thing)
+                    
+                elif unused_thing.status & loading.Status.LOADED != 0:
+                    unused_thing.unload()
+                    logger.debug(notifying.Lines.Unloaded(unused_thing))
+                    unloaded_anything = True
+        
+        for trimmed_thing in self.memory.trim():
+            trimmed_thing.unload()
+            logger.debug(notifying.Lines.Unloaded(trimmed_thing))
+            unloaded_anything = True
+        
+        prefetched_stuff, dropped_stuff = self.memory.prefetch()
+        for dropped_thing in dropped_stuff:
+            if dropped_thing.uses == 0 \
+               and dropped_thing.status & loading.Status.LOADED != 0:
+                dropped_thing.unload()
+                logger.debug(notifying.Lines.Unloaded(dropped_thing))
+                unloaded_anything = True
+        
+        if unloaded_anything:
             gc.collect()
             
         while self.memory.requested_stuff:
             requested_thing = self.memory.requested_stuff.pop()
+            # It might have been waiting to be prefetched
+            requested_thing.prioritize(GLib.PRIORITY_DEFAULT)
             if requested_thing.status & loading.Status.UNLOADED != 0:
                 requested_thing.load()
                 logger.debug(notifying.Lines.Loading(requested_thing))
+        
+        for prefetched_thing, a_priority in prefetched_stuff:
+            prefetched_thing.prioritize(a_priority)
+            prefetched_thing.load()
+            logger.debug(notifying.Lines.Loading(prefetched_thing))
                 
         return False
         
@@ -437,16 +481,20 @@ class ImageViewer(Gtk.Application):
             logger.log(notifying.Lines.Loaded(thing))
     
     
+    def _memory_budget_changed_cb(self, *data):
+        self.memory.budget = self.memory_budget * 1024 * 1024
+    
+    
     def _save_settings(self, app_settings):
         utility.SetDictFromProperties(
             self, self.settings.data,
-            "zoom-effect", "spin-effect"
+            "zoom-effect", "spin-effect", "memory-budget"
         )
     
     def _load_settings(self, app_settings):
         utility.SetPropertiesFromDict(
             self, self.settings.data,
-            "zoom-effect", "spin-effect"
+            "zoom-effect", "spin-effect", "memory-budget"
         )
     
     def _save_mouse_settings(self, mouse_settings):
@@ -475,6 +523,8 @@ class ViewerWindow(Gtk.ApplicationWindow):
         # Idly refresh index
         self._refresh_index = utility.IdlyMethod(self._refresh_index)
         self._refresh_transform = utility.IdlyMethod(self._refresh_transform)
+        self._refresh_prefetch = utility.IdlyMethod(self._refresh_prefetch)
+        self._refresh_prefetch.priority = GLib.PRIORITY_LOW
         
         # If the user changes the magnification after its set by .autozoom, 
         # then .autozoom isn't called after rotating or resizing the imageview
@@ -485,6 +535,7 @@ class ViewerWindow(Gtk.ApplicationWindow):
         # so the image size due to the user panning the view
         self._autozoom_locked_rectangle = None
         self._focus_loaded_handler_id = None
+        self._focus_previewed_handler_id = None
         self._old_focused_image = None
         self.opening_context = None
         self.album = organizing.Album()
@@ -1425,6 +1476,20 @@ class ViewerWindow(Gtk.ApplicationWindow):
                     view.magnification = 1
     
     
+    def get_display_hint(self):
+        """ Returns a display hint for image sources describing how .autozoom
+            will fit an image into the view, or None if it won't shrink it """
+        
+        # Yes, "can magnify" is what allows it to zoom out. See .autozoom
+        if self.autozoom_enabled and self.autozoom_can_magnify:
+            view = self.view
+            view_size = view.get_widget_size()
+            if min(view_size) > 1:
+                return view_size, view.rotation, self.autozoom_mode
+        
+        return None
+    
+    
     def toggle_keep_above(self, *data):
         keep_above = self.actions.get_action("ui-keep-above")
         keep_below = self.actions.get_action("ui-keep-below")
@@ -1527,7 +1592,8 @@ class ViewerWindow(Gtk.ApplicationWindow):
         if source_list:
             # Logging just because
             uilogger.log("Opening %d source(s)" % len(source_list))
-            uilogger.debug_list(source_list)
+            # Listing thousands of sources would take longer than opening
+            uilogger.debug_list(source_list[:LOGGED_SOURCE_LIMIT])
             uilogger.debug("Parameters")
             uilogger.debug_dict({
                 "Replace": replace,
@@ -1542,10 +1608,15 @@ class ViewerWindow(Gtk.ApplicationWindow):
                 uilogger.debug("Selected openers")
                 uilogger.debug_list(openers)
             
+            opening_context = self.get_opening_context()
             if replace:
+                if opening_context.open_sessions:
+                    # Whatever was still being opened is superseded
+                    uilogger.log("Cancelling what was being opened")
+                    opening_context.cancel()
+                
                 del self.album[:]
             
-            opening_context = self.get_opening_context()
             if not opening_context.__added_already:
                 self.app.opener.handle(opening_context, album=self.album)
                 opening_context.__added_already = True
@@ -1554,11 +1625,12 @@ class ViewerWindow(Gtk.ApplicationWindow):
                 opening_context.__go_to_source = source_list[0]
             else:
                 opening_context.__go_to_source = None
+            opening_context.focus_source = opening_context.__go_to_source
             
             opening_session = opening_context.get_new_session()
             opening_session.search_siblings = search_siblings
             opening_session.add_openers(openers)
-            opening_session.add_sources(source_list)
+            opening_session.add_sources_gradually(source_list)
     
     
     def paste(self, clipboard=None):
@@ -1591,6 +1663,7 @@ class ViewerWindow(Gtk.ApplicationWindow):
         except AttributeError:
             # Show an open dialog
             opening_context.hold_open()
+            opening_context.__added_by_dialog = False
             
             dialog = self.app.show_open_image_dialog(
                 self._open_dialog_open_cb,
@@ -1703,7 +1776,10 @@ class ViewerWindow(Gtk.ApplicationWindow):
             uilogger.log_exception()
         
         # Clean up the avl
+        self._refresh_prefetch.cancel_queue()
+        self.app.memory.set_prefetch(self, [])
         self.avl.clean()
+        self.album.clean()
         return Gtk.Window.do_destroy(self)
     
     
@@ -1721,6 +1797,7 @@ class ViewerWindow(Gtk.ApplicationWindow):
     def _album_image_added_cb(self, album, image, index):
         image.lists += 1
         self._refresh_index.queue()
+        self._refresh_prefetch.queue()
         
         context = self.opening_context
         if context and context.__go_to_source:
@@ -1738,10 +1815,23 @@ class ViewerWindow(Gtk.ApplicationWindow):
     def _album_image_removed_cb(self, album, image, index):
         image.lists -= 1
         self._refresh_index.queue()
+        self._refresh_prefetch.queue()
         
         
     def _album_order_changed_cb(self, album):
         self._refresh_index.queue()
+        self._refresh_prefetch.queue()
+        
+        
+    def _refresh_prefetch(self):
+        """ Tells the memory manager which images might be shown next """
+        hints = self.avl.get_prefetch_hints()
+        display_hint = self.get_display_hint()
+        for an_image, a_priority in hints:
+            if not an_image.is_loaded:
+                an_image.display_hint = display_hint
+        
+        self.app.memory.set_prefetch(self, hints)
 
 
     def _focus_changed(self, avl, focused_image, hint):
@@ -1749,16 +1839,26 @@ class ViewerWindow(Gtk.ApplicationWindow):
             self._old_focused_image.disconnect(self._focus_loaded_handler_id)
             self._focus_loaded_handler_id = None
         
+        if self._focus_previewed_handler_id:
+            self._old_focused_image.disconnect(
+                self._focus_previewed_handler_id
+            )
+            self._focus_previewed_handler_id = None
+        
         self._old_focused_image = focused_image
         self._focus_hint = hint
         
         self._refresh_index.queue()
+        self._refresh_prefetch.queue()
         self.refresh_title(focused_image)
         
         loading_ctx = self.statusbar.get_context_id("loading")
         self.statusbar.pop(loading_ctx)
         
         if focused_image:
+            if not focused_image.is_loaded:
+                focused_image.display_hint = self.get_display_hint()
+            
             if focused_image.is_loaded or focused_image.is_bad:
                 self.loading_spinner.hide()
                 self.loading_spinner.stop()
@@ -1783,11 +1883,31 @@ class ViewerWindow(Gtk.ApplicationWindow):
                 self._focus_loaded_handler_id = focused_image.connect(
                     "finished-loading", self._focus_loaded
                 )
+                if focused_image.is_displayable:
+                    self._refresh_focus_frame()
+                else:
+                    self._focus_previewed_handler_id = focused_image.connect(
+                        "data-changed", self._focus_previewed
+                    )
         else:
             self.loading_spinner.hide()
             self.loading_spinner.stop()
             
+    def _focus_previewed(self, image):
+        if image.is_displayable:
+            # Autozoom to the preview rather than waiting the image to load
+            image.disconnect(self._focus_previewed_handler_id)
+            self._focus_previewed_handler_id = None
+            if self.avl.focus_image == image:
+                self._refresh_focus_frame()
+            
     def _focus_loaded(self, image, error):
+        # If a preview was shown the frame has been refreshed already
+        previewed = self._focus_previewed_handler_id is None
+        if self._focus_previewed_handler_id:
+            image.disconnect(self._focus_previewed_handler_id)
+            self._focus_previewed_handler_id = None
+        
         focused_image = self.avl.focus_image
         if focused_image == image:
             # Hide loading hints #
@@ -1802,7 +1922,8 @@ class ViewerWindow(Gtk.ApplicationWindow):
                 self.statusbar.push(loading_ctx, message)
                 
             # Refresh frame #
-            self._refresh_focus_frame()
+            if error or not previewed:
+                self._refresh_focus_frame()
                 
         self._old_focused_image.disconnect(self._focus_loaded_handler_id)
         self._focus_loaded_handler_id = None
@@ -1939,9 +2060,10 @@ class ViewerWindow(Gtk.ApplicationWindow):
         """ Callback for the open image dialog "open" button """
         opening_context = self.get_opening_context()
         
-        # If something was opened with this context before the open button
-        # was pressed, then we wouldn't want to replace that
-        replace = not opening_context.__added_already
+        # If something was added with this dialog before the open button
+        # was pressed, then we wouldn't want to replace that. Anything
+        # else is replaced, even if it's still being opened
+        replace = not opening_context.__added_by_dialog
         
         # Search for sibling files when only one file is selected
         search_siblings = replace and len(uris) == 1
@@ -1955,6 +2077,7 @@ class ViewerWindow(Gtk.ApplicationWindow):
     def _open_dialog_add_cb(self, uris, openers, *etc):
         """ Callback for the open image dialog "add" button """
         opening_context = self.get_opening_context()
+        opening_context.__added_by_dialog = True
         self.open_uris(uris, openers=openers)
         return True
     
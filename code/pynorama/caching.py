@@ -0,0 +1,729 @@
+""" caching.py keeps around things that are expensive to get again, like
+    previews and sizes of images, so that they survive between sessions """
+
+""" ...and this file is part of Pynorama.
+    
+    Pynorama is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    Pynorama is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with Pynorama. If not, see <http://www.gnu.org/licenses/>. """
+
+from gi.repository import GdkPixbuf, GLib
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, namedtuple
+
+SOFTWARE_NAME = "Pynorama"
+# How many bytes of downloaded files are kept between sessions
+DOWNLOAD_CACHE_LIMIT = 256 * 1024 * 1024
+# Seconds after a lookup that the download cache records the file was
+# used, so looking up a lot of URIs at once is committed together
+DOWNLOAD_CACHE_COMMIT_DELAY = 2
+# How many directory listings are kept between sessions
+LISTING_CACHE_LIMIT = 1024
+
+
+class ThumbnailCache:
+    """ Reads and writes thumbnails in the freedesktop.org thumbnail cache
+    
+    Thumbnails are PNG files named after the MD5 of the URI of the image
+    they are for, stored in a directory for each size, and they carry the
+    URI, modification time and size of the image so that outdated ones can
+    be told apart. See the Thumbnail Managing Standard for the details.
+    
+    Everything here does file IO, so it should be run in a worker.
+    
+    """
+    
+    # (directory name, maximum width and height) from the largest size
+    SIZES = (("xx-large", 1024), ("x-large", 512), ("large", 256))
+    # Thumbnails are written at these sizes
+    STORED_SIZES = ("x-large", "large")
+    
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(GLib.get_user_cache_dir(), "thumbnails")
+        
+        self.directory = directory
+    
+    
+    def get_path(self, uri, size_name):
+        """ Returns where the thumbnail of an URI of a size would be """
+        digest = hashlib.md5(uri.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, size_name, digest + ".png")
+    
+    
+    def is_thumbnail(self, gfile):
+        """ Whether a file is in the thumbnail directory itself """
+        path = gfile.get_path()
+        return bool(path) and os.path.abspath(path).startswith(
+            os.path.join(self.directory, "")
+        )
+    
+    
+    def lookup(self, uri, mtime, size):
+        """ Returns the largest up to date thumbnail of an URI
+        
+        The result is a (pixbuf, image size) tuple where image size is the
+        width and height of the original image if the thumbnail says it,
+        or None if there is no thumbnail for the URI whose modification
+        time and size match.
+        
+        """
+        for a_size_name, a_size in self.SIZES:
+            path = self.get_path(uri, a_size_name)
+            if not os.path.exists(path):
+                continue
+            
+            try:
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+            except GLib.GError:
+                continue
+            
+            get_option = pixbuf.get_option
+            try:
+                valid = (
+                    get_option("tEXt::Thumb::URI") == uri
+                    and int(get_option("tEXt::Thumb::MTime")) == int(mtime)
+                )
+                stored_size = get_option("tEXt::Thumb::Size")
+                if valid and stored_size is not None:
+                    valid = int(stored_size) == size
+                
+            except (TypeError, ValueError):
+                valid = False
+            
+            if valid:
+                # These are optional
+                try:
+                    image_size = (
+                        int(get_option("tEXt::Thumb::Image::Width")),
+                        int(get_option("tEXt::Thumb::Image::Height"))
+                    )
+                except (TypeError, ValueError):
+                    image_size = None
+                
+                return pixbuf, image_size
+        
+        return None
+    
+    
+    def shrink(self, pixbuf):
+        """ Returns a pixbuf scaled down to the largest size thumbnails are
+            written at, or the pixbuf itself if it's not larger than that """
+        sizes = dict(self.SIZES)
+        largest = max(sizes[a_size_name] for a_size_name in self.STORED_SIZES)
+        width, height = pixbuf.get_width(), pixbuf.get_height()
+        scale = largest / max(width, height)
+        if scale >= 1:
+            return pixbuf
+        
+        return pixbuf.scale_simple(
+            max(1, round(width * scale)), max(1, round(height * scale)),
+            GdkPixbuf.InterpType.BILINEAR
+        )
+    
+    
+    def store(self, uri, mtime, size, pixbuf, image_size):
+        """ Writes thumbnails of an image from a pixbuf of it
+        
+        The pixbuf can be the image at any size, thumbnails larger than it
+        are not written. image_size is the width and height of the image.
+        Returns whether anything was written.
+        
+        """
+        image_width, image_height = image_size
+        keys = [
+            "tEXt::Thumb::URI", "tEXt::Thumb::MTime", "tEXt::Thumb::Size",
+            "tEXt::Thumb::Image::Width", "tEXt::Thumb::Image::Height",
+            "tEXt::Software"
+        ]
+        values = [
+            uri, str(int(mtime)), str(size),
+            str(image_width), str(image_height),
+            SOFTWARE_NAME
+        ]
+        
+        wrote_anything = False
+        sizes = dict(self.SIZES)
+        for a_size_name in self.STORED_SIZES:
+            a_size = sizes[a_size_name]
+            width, height = pixbuf.get_width(), pixbuf.get_height()
+            # Small images are stored as they are, large pixbufs that are
+            # not large enough for a thumbnail size are skipped
+            if max(width, height) < a_size \
+               and max(image_width, image_height) > max(width, height):
+                continue
+            
+            scale = min(1, a_size / max(width, height))
+            if scale < 1:
+                pixbuf = pixbuf.scale_simple(
+                    max(1, round(width * scale)),
+                    max(1, round(height * scale)),
+                    GdkPixbuf.InterpType.BILINEAR
+                )
+            
+            path = self.get_path(uri, a_size_name)
+            try:
+                self._write(path, pixbuf, keys, values)
+            except (GLib.GError, OSError):
+                # Read only or full disks are no reason to bother anyone
+                return wrote_anything
+            
+            wrote_anything = True
+        
+        return wrote_anything
+    
+    
+    def _write(self, path, pixbuf, keys, values):
+        # Thumbnails are private, and written to a temporary file first so
+        # nobody else ever reads half a thumbnail
+        directory = os.path.dirname(path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        
+        descriptor, temporary_path = tempfile.mkstemp(
+            ".png", "pynorama-", directory
+        )
+        os.close(descriptor)
+        try:
+            pixbuf.savev(temporary_path, "png", keys, values)
+            os.chmod(temporary_path, 0o600)
+            os.replace(temporary_path, path)
+        except:
+            os.unlink(temporary_path)
+            raise
+
+
+# Shared by everything that wants thumbnails
+Thumbnails = ThumbnailCache()
+
+
+class MetadataCache:
+    """ Keeps the image sizes read from files in an SQLite database
+    
+    Records are keyed by the URI, modification time and size of a file,
+    so a record of a file that has changed is never found. These are
+    cheap to get from a file info, while the image size needs reading
+    the file. Can be used from any thread.
+    
+    """
+    
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(
+                GLib.get_user_cache_dir(), "pynorama", "metadata.sqlite"
+            )
+        
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+        self._pending = 0
+    
+    
+    def lookup(self, uri, mtime, size):
+        """ Returns the (width, height) recorded for an URI
+            or None if there isn't an up to date record of it """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return None
+            
+            try:
+                row = connection.execute(
+                    "SELECT width, height FROM images "
+                    "WHERE uri = ? AND mtime = ? AND size = ?",
+                    (uri, int(mtime), size)
+                ).fetchone()
+            except sqlite3.Error:
+                return None
+        
+        return tuple(row) if row else None
+    
+    
+    def store(self, uri, mtime, size, image_size):
+        """ Records the width and height of the image in an URI
+        
+        Records are written to the disk by .commit()
+        
+        """
+        width, height = image_size
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return
+            
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO images "
+                    "(uri, mtime, size, width, height) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (uri, int(mtime), size, width, height)
+                )
+            except sqlite3.Error:
+                return
+            
+            self._pending += 1
+    
+    
+    def commit(self):
+        """ Writes the records stored since the last commit """
+        with self._lock:
+            if self._connection and self._pending:
+                self._pending = 0
+                try:
+                    self._connection.commit()
+                except sqlite3.Error:
+                    pass
+    
+    
+    def _connect(self):
+        if self._connection is None:
+            try:
+                os.makedirs(
+                    os.path.dirname(self.path), mode=0o700, exist_ok=True
+                )
+                connection = sqlite3.connect(
+                    self.path, check_same_thread=False
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS images ("
+                    "uri TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, "
+                    "width INTEGER, height INTEGER)"
+                )
+                connection.commit()
+                
+            except (sqlite3.Error, OSError):
+                # Not having a cache is no reason to bother anyone,
+                # and trying again every time would be slow
+                self._connection = False
+            
+            else:
+                self._connection = connection
+        
+        return self._connection or None
+
+
+# Shared by everything that reads image sizes from files
+MetadataRecords = MetadataCache()
+
+
+class ListingCache:
+    """ Keeps which files were found in directories in an SQLite database
+    
+    A listing is a list of (file name, content type) tuples of the files
+    kept from a directory and a list of its subdirectory names. Listings
+    are keyed by the directory path and a string telling which files were
+    kept, and they're only found while the directory modification time is
+    the same as when they were stored, which changes whenever files are
+    added, removed or renamed in it. Only the .limit most recently used
+    listings are kept. Can be used from any thread.
+    
+    """
+    
+    def __init__(self, path=None, limit=LISTING_CACHE_LIMIT):
+        if path is None:
+            path = os.path.join(
+                GLib.get_user_cache_dir(), "pynorama", "listings.sqlite"
+            )
+        
+        self.path = path
+        self.limit = limit
+        self._connection = None
+        self._lock = threading.Lock()
+        self._pending = 0
+    
+    
+    def lookup(self, directory, kept, mtime):
+        """ Returns the (files, subdirectory names) recorded for a
+            directory or None if there isn't an up to date record of it """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return None
+            
+            try:
+                row = connection.execute(
+                    "SELECT files, subdirectories FROM listings "
+                    "WHERE directory = ? AND kept = ? AND mtime = ?",
+                    (directory, kept, mtime)
+                ).fetchone()
+                if row is None:
+                    return None
+                
+                connection.execute(
+                    "UPDATE listings SET used = ? "
+                    "WHERE directory = ? AND kept = ?",
+                    (time.time(), directory, kept)
+                )
+                self._pending += 1
+                
+            except (sqlite3.Error, UnicodeError):
+                # e.g. paths that aren't valid UTF-8
+                return None
+        
+        files, subdirectories = row
+        return (
+            [tuple(a_file) for a_file in json.loads(files)],
+            json.loads(subdirectories)
+        )
+    
+    
+    def store(self, directory, kept, mtime, files, subdirectories):
+        """ Records the listing of a directory
+        
+        Records are written to the disk by .commit()
+        
+        """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return
+            
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO listings "
+                    "(directory, kept, mtime, files, subdirectories, used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (directory, kept, mtime, json.dumps(files),
+                     json.dumps(subdirectories), time.time())
+                )
+            except (sqlite3.Error, UnicodeError):
+                return
+            
+            self._pending += 1
+    
+    
+    def commit(self):
+        """ Writes the records stored since the last commit and forgets
+            the least recently used ones past the limit """
+        with self._lock:
+            if self._connection and self._pending:
+                self._pending = 0
+                try:
+                    self._connection.execute(
+                        "DELETE FROM listings WHERE rowid NOT IN ("
+                        "SELECT rowid FROM listings "
+                        "ORDER BY used DESC LIMIT ?)",
+                        (self.limit,)
+                    )
+                    self._connection.commit()
+                except sqlite3.Error:
+                    pass
+    
+    
+    def _connect(self):
+        if self._connection is None:
+            try:
+                os.makedirs(
+                    os.path.dirname(self.path), mode=0o700, exist_ok=True
+                )
+                connection = sqlite3.connect(
+                    self.path, check_same_thread=False
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS listings ("
+                    "directory TEXT, kept TEXT, mtime INTEGER, "
+                    "files TEXT, subdirectories TEXT, used REAL, "
+                    "PRIMARY KEY (directory, kept))"
+                )
+                connection.commit()
+                
+            except (sqlite3.Error, OSError):
+                self._connection = False
+            
+            else:
+                self._connection = connection
+        
+        return self._connection or None
+
+
+# Shared by everything that lists directories
+DirectoryListings = ListingCache()
+
+
+class DownloadCache:
+    """ Keeps files downloaded from URIs between sessions
+    
+    Files are kept in a directory with their URI, ETag and modification
+    time recorded in an SQLite database, so a downloader can ask the
+    server whether they have changed instead of downloading them again.
+    When the files take more than .limit bytes the least recently used
+    ones are deleted, except for those handed out by .lookup() or .store()
+    and not given back to .release() yet, since images opened from them
+    may have to be loaded again.
+    Should be used from the main thread.
+    
+    """
+    
+    Record = namedtuple("Record", "path etag modified validated")
+    
+    def __init__(self, directory=None, limit=DOWNLOAD_CACHE_LIMIT):
+        if directory is None:
+            directory = os.path.join(
+                GLib.get_user_cache_dir(), "pynorama", "downloads"
+            )
+        
+        self.directory = directory
+        self.limit = limit
+        self._connection = None
+        self._commit_id = None
+        # How many times each file was handed out and not released yet
+        self._in_use = Counter()
+    
+    
+    def lookup(self, uri):
+        """ Returns a .Record of the file downloaded from an URI
+            or None if it isn't in the cache. The file is kept until
+            its path is given to .release() """
+        connection = self._connect()
+        if connection is None:
+            return None
+        
+        try:
+            row = connection.execute(
+                "SELECT filename, etag, modified, validated FROM downloads "
+                "WHERE uri = ?", (uri,)
+            ).fetchone()
+            if row is None:
+                return None
+            
+            filename, etag, modified, validated = row
+            path = os.path.join(self.directory, filename)
+            if not os.path.isfile(path):
+                self._remove(connection, uri, filename)
+                return None
+            
+            connection.execute(
+                "UPDATE downloads SET used = ? WHERE uri = ?",
+                (time.time(), uri)
+            )
+            
+        except sqlite3.Error:
+            return None
+        
+        if self._commit_id is None:
+            self._commit_id = GLib.timeout_add_seconds(
+                DOWNLOAD_CACHE_COMMIT_DELAY, self._commit_cb
+            )
+        
+        self._in_use[filename] += 1
+        return DownloadCache.Record(path, etag, modified, validated)
+    
+    
+    def get_download_path(self):
+        """ Returns a new path in the cache directory to download into
+            or None if the cache can't be written to """
+        if self._connect() is None:
+            return None
+        
+        try:
+            file_descriptor, path = tempfile.mkstemp(
+                dir=self.directory, suffix=".part"
+            )
+        except OSError:
+            return None
+        
+        os.close(file_descriptor)
+        return path
+    
+    
+    def get_path(self, uri, suffix=""):
+        """ Returns where the file downloaded from an URI is stored """
+        digest = hashlib.sha1(uri.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+    
+    
+    def store(self, uri, download_path, suffix="", etag=None, modified=None):
+        """ Moves a file downloaded from an URI into the cache
+        
+        Returns the path the file was moved to, or None if it couldn't be
+        kept, in which case the file is left where it was. The file is kept
+        until its path is given to .release().
+        
+        """
+        connection = self._connect()
+        if connection is None:
+            return None
+        
+        path = self.get_path(uri, suffix)
+        filename = os.path.basename(path)
+        now = time.time()
+        try:
+            row = connection.execute(
+                "SELECT filename FROM downloads WHERE uri = ?", (uri,)
+            ).fetchone()
+            if row and row[0] != filename:
+                self._remove(connection, uri, row[0])
+            
+            size = os.path.getsize(download_path)
+            os.replace(download_path, path)
+            connection.execute(
+                "INSERT OR REPLACE INTO downloads "
+                "(uri, filename, etag, modified, size, validated, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (uri, filename, etag, modified, size, now, now)
+            )
+            self._in_use[filename] += 1
+            self._evict(connection)
+            connection.commit()
+            
+        except (sqlite3.Error, OSError):
+            return None
+        
+        return path
+    
+    
+    def release(self, path):
+        """ Lets a file handed out by .lookup() or .store() be evicted once
+            every time it was handed out was released """
+        filename = os.path.basename(path)
+        self._in_use[filename] -= 1
+        if self._in_use[filename] > 0:
+            return
+        
+        del self._in_use[filename]
+        connection = self._connect()
+        if connection is None:
+            return
+        
+        try:
+            row = connection.execute(
+                "SELECT uri FROM downloads WHERE filename = ?", (filename,)
+            ).fetchone()
+        except sqlite3.Error:
+            return
+        
+        if row is None:
+            # Evicted while it was in use
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    
+    def revalidate(self, uri):
+        """ Records that the cached file of an URI is still up to date """
+        connection = self._connect()
+        if connection is not None:
+            try:
+                connection.execute(
+                    "UPDATE downloads SET validated = ? WHERE uri = ?",
+                    (time.time(), uri)
+                )
+                connection.commit()
+            except sqlite3.Error:
+                pass
+    
+    
+    def commit(self):
+        """ Writes when the files looked up since the last commit were
+            used, which is otherwise done a while after a lookup """
+        if self._commit_id is not None:
+            GLib.source_remove(self._commit_id)
+            self._commit_id = None
+        
+        if self._connection:
+            try:
+                self._connection.commit()
+            except sqlite3.Error:
+                pass
+    
+    
+    def _commit_cb(self):
+        self._commit_id = None
+        self.commit()
+        return False
+    
+    
+    def _evict(self, connection):
+        total, = connection.execute(
+            "SELECT TOTAL(size) FROM downloads"
+        ).fetchone()
+        if total <= self.limit:
+            return
+        
+        rows = connection.execute(
+            "SELECT uri, filename, size FROM downloads ORDER BY used"
+        ).fetchall()
+        for uri, filename, size in rows:
+            if total <= self.limit:
+                break
+            
+            # Files in use are removed once they are released
+            if filename not in self._in_use:
+                self._remove(connection, uri, filename)
+                total -= size
+    
+    
+    def _remove(self, connection, uri, filename):
+        connection.execute("DELETE FROM downloads WHERE uri = ?", (uri,))
+        if filename in self._in_use:
+            return
+        
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+    
+    
+    def _remove_strays(self, connection):
+        """ Removes files left behind by the last sessions, e.g. partial
+            downloads and files that were in use when they were evicted """
+        recorded = {
+            filename for filename,
+            in connection.execute("SELECT filename FROM downloads")
+        }
+        # Other instances may be downloading into the recent ones
+        too_recent = time.time() - 24 * 60 * 60
+        for a_name in os.listdir(self.directory):
+            if a_name in recorded or a_name.startswith("downloads.sqlite"):
+                continue
+            
+            a_path = os.path.join(self.directory, a_name)
+            try:
+                if os.path.getmtime(a_path) < too_recent:
+                    os.remove(a_path)
+            except OSError:
+                pass
+    
+    
+    def _connect(self):
+        if self._connection is None:
+            try:
+                os.makedirs(self.directory, mode=0o700, exist_ok=True)
+                connection = sqlite3.connect(
+                    os.path.join(self.directory, "downloads.sqlite")
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS downloads ("
+                    "uri TEXT PRIMARY KEY, filename TEXT, etag TEXT, "
+                    "modified INTEGER, size INTEGER, "
+                    "validated REAL, used REAL)"
+                )
+                connection.commit()
+                self._remove_strays(connection)
+                
+            except (sqlite3.Error, OSError):
+                self._connection = False
+            
+            else:
+                self._connection = connection
+        
+        return self._connection or None
+
+
+# Shared by everything that downloads files
+DownloadedFiles = DownloadCache()
@@ -1,4 +1,4 @@
-""" extrators.py adds support to open archive extractors."""
+""" extrators.py adds support to open images inside archives."""
 
 """ ...and this file is part of Pynorama.
     
@@ -15,67 +15,664 @@
     You should have received a copy of the GNU General Public License
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. """
 
+import tarfile
+import threading
+import time
 import zipfile
-import tempfile
+import zlib
+from bisect import bisect_right
 from gettext import gettext as _
-import os
-from os.path import join as join_path
+from os.path import splitext
 
-from gi.repository import Gio, GObject
+from gi.repository import GdkPixbuf, Gio, GLib, GObject
 
 from pynorama.extending import Opener
-from pynorama import extending, opening
-from pynorama.components import openers
+from pynorama.loading import Status
+from pynorama import extending, loading, opening, utility, viewing
+from pynorama.components import loaders, openers
 
-class ZipOpener(Opener, openers.GFileOpener):
-    CODENAME = "zip"
+# The .kind of the FileSources of archive members
+ARCHIVE_MEMBER_KIND = "archive-member"
+
+# How many bytes of compressed files are decompressed at a time
+DECOMPRESSION_CHUNK_SIZE = 64 * 1024
+# About how many uncompressed bytes there are between seek points at first
+SEEK_POINT_SPACING = 4 * 1024 * 1024
+# Each seek point keeps a copy of a zlib decompressor, its 32 KiB window
+# and state, so about 40 KiB. Once a file has more than this many of them
+# every other one is dropped and the spacing doubles, which keeps the
+# points of a gzip file under 10 MiB however large it is, at the cost of
+# decompressing more before each member of very large files.
+SEEK_POINT_LIMIT = 256
+# zlib window bits for reading gzip headers
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def ReadStreamImageSize(stream):
+    """ Returns the width and height of an image from a file object by
+        reading only until GdkPixbuf figures them out, or (0, 0) """
+    sizes = []
+    loader = GdkPixbuf.PixbufLoader()
+    loader.connect(
+        "size-prepared", lambda loader, w, h: sizes.append((w, h))
+    )
+    try:
+        while not sizes:
+            chunk = stream.read(loading.HEADER_CHUNK_SIZE)
+            if not chunk:
+                break
+            
+            loader.write(chunk)
+        
+    except GLib.GError:
+        pass
+        
+    finally:
+        try:
+            loader.close()
+        except GLib.GError:
+            # It's obviously missing most of the image
+            pass
     
-    def __init__(self):
-        Opener.__init__(self, ZipOpener.CODENAME, opening.GFileSource.KIND)
-        openers.GFileOpener.__init__(self, mime_types={"application/zip"})
+    return sizes[0] if sizes else (0, 0)
+
+
+def GetImageExtensions():
+    """ Returns a set of the extensions of GdkPixbuf supported formats """
+    result = set()
+    for a_format in GdkPixbuf.Pixbuf.get_formats():
+        result.update(a_format.get_extensions())
     
+    return result
+
+
+class ZipArchive:
+    """ A zip file whose members are read from workers
     
-    @GObject.Property
-    def label(self):
-        return _("Zipfile Archives")
+    The file is opened once, the first time a member is read, and it's
+    shared by every image in the archive.
     
+    """
     
-    def open_file_source(self, context, results, source):
-        """ Opens a directory file and yields its contents """
+    def __init__(self, path):
+        self.path = path
+        self._zipfile = None
+        self._lock = threading.Lock()
+    
+    
+    def open(self, name):
+        """ Returns a file object for reading a member """
+        with self._lock:
+            if self._zipfile is None:
+                self._zipfile = zipfile.ZipFile(self.path)
+            
+            return self._zipfile.open(name)
+    
+    
+    def read(self, name):
+        """ Returns the decompressed data of a member """
+        with self.open(name) as member_file:
+            return member_file.read()
+
+
+class ArchiveImageSource(loading.ImageSource):
+    """ An image in an archive that is decoded from memory in a worker
+    
+    The archive must have .open(member) and .read(member) methods that
+    work from a worker.
+    
+    """
+    
+    def __init__(self, archive, member, file_source,
+                 data_size=0, modification_date=None):
+        loading.ImageSource.__init__(self, file_source)
+        self.archive = archive
+        self.member = member
+        self.data_size = data_size
+        self.modification_date = modification_date
+        
+        self.surface = None
+        self.pyramid = None
+        self.image_size = None
+        
+        self._decoding_job = None
+        self._upgrading_job = None
+        self._upgrading_failed = False
+    
+    
+    def load(self):
+        if self.is_loading:
+            raise Exception
+        
+        self.status = Status.LOADING
+        self._decoding_job = utility.Workers.run(
+            self._decode, self.display_hint,
+            callback=self._decoded, priority=self.load_priority
+        )
+    
+    
+    def prioritize(self, priority):
+        loading.ImageSource.prioritize(self, priority)
+        if self._decoding_job:
+            utility.Workers.reprioritize(self._decoding_job, priority)
+    
+    
+    def _decode(self, display_hint):
+        """ Decodes the image into a surface. Runs in a worker.
+            Returns a (surface, image size) tuple """
+        data = GLib.Bytes.new(self.archive.read(self.member))
+        stream = Gio.MemoryInputStream.new_from_bytes(data)
+        image_sizes = []
+        pixbuf = loaders.DecodeStream(
+            stream, None, loaders.FitDisplayHint, display_hint, image_sizes
+        )
+        surface = utility.SurfaceFromPixbuf(pixbuf)
+        if image_sizes:
+            image_size = image_sizes[0]
+        else:
+            image_size = surface.get_width(), surface.get_height()
+        
+        return surface, image_size
+    
+    
+    def _decoded(self, job):
+        self._decoding_job = None
+        self.error = None
+        try:
+            self.surface, self.image_size = job.finish()
+            
+        except Exception as e:
+            self.surface = None
+            self.status = Status.UNLOADED
+            self.error = e
+            
+        else:
+            self.pyramid = utility.SurfacePyramid(
+                self.surface, self._pyramid_ready_cb
+            )
+            width, height = self.image_size
+            self.is_reduced = (
+                self.surface.get_width() < width
+                or self.surface.get_height() < height
+            )
+            self._upgrading_failed = False
+            self.status = Status.LOADED
+            self.load_metadata()
+            
+        finally:
+            self.emit("finished-loading", self.error)
+    
+    
+    def request_full_resolution(self):
+        if (self.is_loaded and self.is_reduced
+                and not self._upgrading_job and not self._upgrading_failed):
+            self._upgrading_job = utility.Workers.run(
+                self._decode, None,
+                callback=self._upgraded, priority=GLib.PRIORITY_LOW
+            )
+    
+    
+    def _upgraded(self, job):
+        self._upgrading_job = None
+        try:
+            surface, image_size = job.finish()
+        except Exception:
+            self._upgrading_failed = True
+        else:
+            self.pyramid.cancel()
+            self.surface = surface
+            self.pyramid = utility.SurfacePyramid(
+                surface, self._pyramid_ready_cb
+            )
+            self.is_reduced = False
+            self.emit("data-changed")
+    
+    
+    def _pyramid_ready_cb(self):
+        self.emit("data-changed")
+    
+    
+    def get_memory_usage(self):
+        return loaders.SurfaceSourceMemoryUsage(self)
+    
+    
+    def unload(self):
+        self.status = Status.UNLOADING
+        
+        if self._decoding_job:
+            self._decoding_job.cancel()
+            self._decoding_job = None
+        
+        if self._upgrading_job:
+            self._upgrading_job.cancel()
+            self._upgrading_job = None
+        
+        if self.pyramid:
+            self.pyramid.cancel()
+            self.pyramid = None
+        
+        self.surface = None
+        self.is_reduced = False
+        self.status = Status.UNLOADED
+    
+    
+    def _fill_metadata(self, metadata):
+        metadata.data_size = self.data_size
+        if self.modification_date is None:
+            metadata.modification_date = float(time.time())
+        else:
+            metadata.modification_date = self.modification_date
+    
+    
+    def load_metadata(self):
+        # The image size is only known without decompressing
+        # anything once the image has been decoded
+        if self.metadata is None:
+            self.metadata = loading.ImageMeta()
+        
+        self._fill_metadata(self.metadata)
+        if self.image_size:
+            self.metadata.width, self.metadata.height = self.image_size
+            self.metadata.is_complete = True
+    
+    
+    def read_metadata(self):
+        metadata = loading.ImageMeta()
+        self._fill_metadata(metadata)
+        try:
+            with self.archive.open(self.member) as member_file:
+                size = ReadStreamImageSize(member_file)
+        except Exception:
+            size = 0, 0
+        
+        metadata.width, metadata.height = size
+        metadata.is_complete = True
+        return metadata
+    
+    
+    def create_frame(self):
+        return viewing.SurfaceSourceImageFrame(self)
+    
+    
+    def copy_to_clipboard(self, clipboard):
+        pixbuf = utility.PixbufFromSurface(self.surface)
+        clipboard.set_image(pixbuf)
+
+
+class TarArchive:
+    """ A plain tar file whose members are read by seeking to them
+    
+    Members are (offset, size) tuples of their data in the file.
+    
+    """
+    
+    def __init__(self, path):
+        self.path = path
+    
+    
+    def open(self, member):
+        """ Returns a file object for reading a member """
+        offset, size = member
+        a_file = open(self.path, "rb")
+        try:
+            a_file.seek(offset)
+        except:
+            a_file.close()
+            raise
         
-        # TODO: Add asynchronous loading
+        return MemberFile(a_file, size)
+    
+    
+    def read(self, member):
+        """ Returns the data of a member """
+        with self.open(member) as member_file:
+            return member_file.read()
+
+
+class GzipTarArchive(TarArchive):
+    """ A gzip compressed tar file with seek points into its data
+    
+    Seek points are (compressed offset, uncompressed offset, zlib
+    decompressor) tuples saved while the file was indexed. Reading a
+    member only decompresses from the seek point before it, instead of
+    from the start of the file. The seek points must be complete, since
+    GzipStream changes the list while indexing.
+    
+    """
+    
+    def __init__(self, path, seek_points):
+        TarArchive.__init__(self, path)
+        self.seek_points = list(seek_points)
+        self._uncompressed_offsets = [point[1] for point in seek_points]
+    
+    
+    def open(self, member):
+        offset, size = member
+        index = bisect_right(self._uncompressed_offsets, offset) - 1
+        compressed_offset, uncompressed_offset, decompressor = \
+            self.seek_points[index]
         
-        gfile = source.gfile
-        path = gfile.get_path()
-        a_zipfile = None
+        a_file = open(self.path, "rb")
         try:
-            a_zipfile = zipfile.ZipFile(path)
+            a_file.seek(compressed_offset)
+            stream = GzipStream(a_file, decompressor.copy())
+            stream.skip(offset - uncompressed_offset)
+        except:
+            a_file.close()
+            raise
+        
+        return MemberFile(stream, size)
+
+
+class MemberFile:
+    """ Reads at most size bytes from a file object, and closes it """
+    
+    def __init__(self, a_file, size):
+        self._file = a_file
+        self._left = size
+    
+    
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        
+        data = self._file.read(size)
+        self._left -= len(data)
+        return data
+    
+    
+    def close(self):
+        self._file.close()
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GzipStream:
+    """ Decompresses a gzip file object from where a decompressor left it
+    
+    Files made of several gzip members are read through. If seek_points
+    is a list, a (compressed offset, uncompressed offset, decompressor)
+    tuple is appended to it about every seek_point_spacing bytes read.
+    When there would be more than seek_point_limit of them, every other
+    one is dropped and the spacing is doubled.
+    
+    """
+    
+    def __init__(self, a_file, decompressor=None,
+                 seek_points=None, seek_point_spacing=0,
+                 seek_point_limit=SEEK_POINT_LIMIT):
+        self._file = a_file
+        self._decompressor = decompressor or zlib.decompressobj(GZIP_WBITS)
+        self._buffer = b""
+        self._compressed_offset = a_file.tell()
+        self._uncompressed_offset = 0
+        
+        self.seek_points = seek_points
+        self.seek_point_spacing = seek_point_spacing
+        self.seek_point_limit = seek_point_limit
+        if seek_points is not None:
+            self._save_seek_point()
+    
+    
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        available = len(self._buffer)
+        while size < 0 or available < size:
+            data = self._decompress_chunk()
+            if data is None:
+                break
+            
+            chunks.append(data)
+            available += len(data)
+        
+        data = b"".join(chunks)
+        if size < 0:
+            size = len(data)
+        
+        result, self._buffer = data[:size], data[size:]
+        return result
+    
+    
+    def skip(self, size):
+        """ Reads and throws away size bytes """
+        while size > 0:
+            data = self.read(min(size, DECOMPRESSION_CHUNK_SIZE))
+            if not data:
+                break
+            
+            size -= len(data)
+    
+    
+    def close(self):
+        self._file.close()
+    
+    
+    def _decompress_chunk(self):
+        """ Returns the data decompressed from a chunk of the file, which
+            may be empty, or None once the file is over """
+        if self._decompressor.eof:
+            unused_data = self._decompressor.unused_data
+            if not unused_data:
+                unused_data = self._file.read(DECOMPRESSION_CHUNK_SIZE)
+                self._compressed_offset += len(unused_data)
             
-            # Caching files
-            directory = tempfile.mkdtemp(
-                suffix=os.sep, dir=context.cache_directory)
-            zipfile_cache = opening.FileCache(directories=[directory])
-            a_zipfile.extractall(directory)
+            if not unused_data.strip(b"\0"):
+                return None # Trailing padding, if anything
             
-            # Returning file source
-            directory_gfile = Gio.File.new_for_path(directory)
-            zip_result = opening.GFileSource(
-                directory_gfile, "", parent=source)
-            zip_result.cache = zipfile_cache
-            results.sources.append(zip_result)
+            # Another gzip member follows
+            self._decompressor = zlib.decompressobj(GZIP_WBITS)
+            data = self._decompressor.decompress(unused_data)
+        else:
+            chunk = self._file.read(DECOMPRESSION_CHUNK_SIZE)
+            if not chunk:
+                return None
+            
+            self._compressed_offset += len(chunk)
+            data = self._decompressor.decompress(chunk)
+        
+        self._uncompressed_offset += len(data)
+        if self.seek_points is not None and not self._decompressor.eof:
+            last_point = self.seek_points[-1][1]
+            if self._uncompressed_offset - last_point >= \
+               self.seek_point_spacing:
+                self._save_seek_point()
+        
+        return data
+    
+    
+    def _save_seek_point(self):
+        # Everything read from the file went through the decompressor,
+        # so it can go on from there on its own
+        self.seek_points.append((
+            self._compressed_offset,
+            self._uncompressed_offset,
+            self._decompressor.copy()
+        ))
+        if len(self.seek_points) > self.seek_point_limit:
+            # The first point, at the start of the file, is always kept
+            self.seek_points[:] = self.seek_points[::2]
+            self.seek_point_spacing *= 2
+
+
+class ArchiveOpener(Opener, openers.GFileOpener):
+    """ Base for openers of the images inside archive files
+    
+    The archive is indexed in a worker by ._index(path), which returns
+    an archive for ArchiveImageSource and a list of
+    (member, name, size, modification date) tuples of its images.
+    
+    """
+    
+    def __init__(self, codename, extensions, mime_types):
+        Opener.__init__(self, codename, opening.GFileSource.KIND)
+        openers.GFileOpener.__init__(self, extensions, mime_types)
+        self.image_extensions = GetImageExtensions()
+    
+    
+    def open_file_source(self, context, results, source):
+        """ Opens an archive file and yields the images inside it """
+        
+        path = source.gfile.get_path()
+        if not path:
+            results.errors.append(
+                Exception("Only local archive files can be opened")
+            )
+            results.complete()
+            return
         
+        utility.Workers.run(
+            self._index, path,
+            callback=lambda job: self._indexed(job, results, source)
+        )
+    
+    
+    def is_image_name(self, name):
+        """ Whether a member name has an image extension """
+        return splitext(name)[1][1:].lower() in self.image_extensions
+    
+    
+    def _index(self, path):
+        raise NotImplementedError
+    
+    
+    def _indexed(self, job, results, source):
+        try:
+            archive, members = job.finish()
         except Exception as e:
             results.errors.append(e)
+        else:
+            images = []
+            for a_member, a_name, a_size, a_date in members:
+                a_member_source = opening.FileSource(
+                    ARCHIVE_MEMBER_KIND, a_name, parent=source
+                )
+                a_member_source.link_parent()
+                images.append(ArchiveImageSource(
+                    archive, a_member, a_member_source, a_size, a_date
+                ))
             
+            results.add_images(images)
         finally:
-            if a_zipfile:
-                a_zipfile.close()
             results.complete()
 
 
+class ZipOpener(ArchiveOpener):
+    """ Opens the images in zip files without extracting them
+    
+    Only the central directory is read while opening, and every member
+    with an image extension becomes an ArchiveImageSource.
+    
+    """
+    
+    CODENAME = "zip"
+    
+    def __init__(self):
+        ArchiveOpener.__init__(
+            self, ZipOpener.CODENAME,
+            {"zip", "cbz"}, {"application/zip", "application/x-cbz"}
+        )
+    
+    
+    @GObject.Property
+    def label(self):
+        return _("Zipfile Archives")
+    
+    
+    def _index(self, path):
+        members = []
+        with zipfile.ZipFile(path) as a_zipfile:
+            for a_member in a_zipfile.infolist():
+                if a_member.filename.endswith("/"):
+                    continue # It's a directory
+                
+                if self.is_image_name(a_member.filename):
+                    date = time.mktime(a_member.date_time + (0, 0, -1))
+                    members.append((
+                        a_member.filename, a_member.filename,
+                        a_member.file_size, date
+                    ))
+        
+        return ZipArchive(path), members
+
+
+class TarOpener(ArchiveOpener):
+    """ Opens the images in tar and gzip compressed tar files
+    
+    The offsets of the images are found while opening, and for gzip
+    compressed files seek points are saved as well, so that each image
+    can be read without extracting or decompressing everything before it.
+    
+    """
+    
+    CODENAME = "tar"
+    
+    def __init__(self):
+        ArchiveOpener.__init__(
+            self, TarOpener.CODENAME,
+            {"tar", "tgz", "cbt"},
+            {
+                "application/x-tar", "application/x-compressed-tar",
+                "application/x-gtar", "application/x-cbt"
+            }
+        )
+    
+    
+    @GObject.Property
+    def label(self):
+        return _("Tar Archives")
+    
+    
+    def _index(self, path):
+        with open(path, "rb") as a_file:
+            is_gzip = a_file.read(2) == b"\x1f\x8b"
+            a_file.seek(0)
+            
+            seek_points = None
+            if is_gzip:
+                seek_points = []
+                stream = GzipStream(
+                    a_file,
+                    seek_points=seek_points,
+                    seek_point_spacing=SEEK_POINT_SPACING,
+                    seek_point_limit=SEEK_POINT_LIMIT
+                )
+                # Compressed files can only be read through once
+                a_tarfile = tarfile.open(fileobj=stream, mode="r|")
+            else:
+                a_tarfile = tarfile.open(fileobj=a_file, mode="r:")
+            
+            members = []
+            with a_tarfile:
+                for a_member in a_tarfile:
+                    if not a_member.isfile():
+                        continue
+                    
+                    if self.is_image_name(a_member.name):
+                        members.append((
+                            (a_member.offset_data, a_member.size),
+                            a_member.name, a_member.size,
+                            float(a_member.mtime)
+                        ))
+        
+        # Seek points are only all there once everything has been read
+        if seek_points is None:
+            archive = TarArchive(path)
+        else:
+            archive = GzipTarArchive(path, seek_points)
+        
+        return archive, members
+
+
 class ArchiveOpeners(extending.ComponentPackage):
     def add_on(self, app):
         components = app.components
         components.add(Opener.CATEGORY, ZipOpener())
+        components.add(Opener.CATEGORY, TarOpener())
 
 extending.LoadedComponentPackages["archive-openers"] = ArchiveOpeners()
@@ -18,7 +18,7 @@
 
 from gi.repository import GLib, GObject, Gtk
 from pynorama import utility, widgets, extending
-from pynorama.organizing import AlbumLayout, LayoutDirection
+from pynorama.organizing import AlbumLayout, LayoutDirection, PrefetchHints
 from gettext import gettext as _
 
 class SingleImageLayout(AlbumLayout):
@@ -30,6 +30,7 @@ class SingleImageLayout(AlbumLayout):
     
     def start(self, avl):
         avl.load_handle = None
+        avl.preview_handle = None
         
         avl.current_image = None
         avl.current_frame = None
@@ -49,6 +50,10 @@ class SingleImageLayout(AlbumLayout):
             avl.current_image.disconnect(avl.load_handle)
         del avl.load_handle
         
+        if avl.preview_handle:
+            avl.current_image.disconnect(avl.preview_handle)
+        del avl.preview_handle
+        
         if avl.current_frame:
             avl.view.remove_frame(avl.current_frame)
         del avl.current_frame
@@ -87,6 +92,10 @@ class SingleImageLayout(AlbumLayout):
             if avl.current_image.is_loading:
                 avl.current_image.cancel_request()
         
+        if avl.preview_handle: # remove "data-changed" handle
+            avl.current_image.disconnect(avl.preview_handle)
+            avl.preview_handle = None
+        
         if avl.previous_image is None and avl.current_frame is not None:
             avl.previous_image = avl.current_image
             avl.previous_frame = avl.current_frame
@@ -105,7 +114,7 @@ class SingleImageLayout(AlbumLayout):
             
         else:
             target_image.request_data()
-            if target_image.is_loaded or target_image.is_bad:
+            if target_image.is_displayable or target_image.is_bad:
                 self._refresh_frame(avl)
                 
             else:
@@ -113,6 +122,11 @@ class SingleImageLayout(AlbumLayout):
                     "finished-loading",
                     self._image_loaded, avl
                 )
+                # The frame is shown as soon as there is a preview of it
+                avl.preview_handle = avl.current_image.connect(
+                    "data-changed",
+                    self._image_previewed, avl
+                )
         
         avl.emit("focus-changed", avl.current_image, False)
     
@@ -162,8 +176,22 @@ class SingleImageLayout(AlbumLayout):
             avl.previous_frame = None
     
     
+    def _image_previewed(self, image, avl):
+        if image.is_displayable:
+            image.disconnect(avl.preview_handle)
+            avl.preview_handle = None
+            self._refresh_frame(avl)
+    
+    
     def _image_loaded(self, image, error, avl):
-        self._refresh_frame(avl)
+        if avl.preview_handle:
+            image.disconnect(avl.preview_handle)
+            avl.preview_handle = None
+        
+        # The frame of a previewed image shows it loaded all the same
+        current_frame = avl.current_frame
+        if current_frame is None or current_frame.source is not image:
+            self._refresh_frame(avl)
 
 
 class ImageStripLayout(GObject.Object, AlbumLayout):
@@ -236,8 +264,9 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
             if a_frame:
                 avl.view.remove_frame(a_frame)
                 
-        for an_image, a_handle_id in avl.load_handles.items():
-            an_image.disconnect(a_handle_id)
+        for an_image, some_handle_ids in avl.load_handles.items():
+            for a_handle_id in some_handle_ids:
+                an_image.disconnect(a_handle_id)
             an_image.cancel_request()
         
         del avl.center_image, avl.center_frame
@@ -272,6 +301,20 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
         return avl.center_frame
     
     
+    def get_prefetch_hints(self, avl):
+        # The shown images are requested already, so the images
+        # around the ends of the strip are the ones to be prefetched
+        shown_images = avl.shown_images
+        if not shown_images:
+            return []
+        
+        hints = PrefetchHints(
+            avl.album, shown_images[-1], shown_images[0],
+            self.prefetch_forward, self.prefetch_backwards
+        )
+        return [a_hint for a_hint in hints if a_hint[0] not in shown_images]
+    
+    
     def go_next(self, avl):
         if avl.center_frame:
             new_index = avl.center_index + 1
@@ -592,9 +635,10 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
         
         if image not in avl.shown_images:
             # If the image is no longer shown, remove the loading handler
-            load_handle_id = avl.load_handles.pop(image, None)
-            if load_handle_id:
-                image.disconnect(load_handle_id)
+            load_handle_ids = avl.load_handles.pop(image, None)
+            if load_handle_ids:
+                for a_handle_id in load_handle_ids:
+                    image.disconnect(a_handle_id)
                 image.cancel_request()
         
         if avl.center_image and index < avl.center_index:
@@ -616,22 +660,28 @@ class ImageStripLayout(GObject.Object, AlbumLayout):
     
     
     def _load_frame(self, avl, image):
-        if image.is_loaded or image.is_bad:
+        if image.is_displayable or image.is_bad:
             self._refresh_frames(avl, image)
             avl.update_sides.queue()
             
-        else:
-            load_handle_id = avl.load_handles.get(image, None)
-            if not load_handle_id:
-                load_handle_id = image.connect(
-                    "finished-loading", self._image_loaded, avl)
-                avl.load_handles[image] = load_handle_id
+        elif image not in avl.load_handles:
+            # Frames are created as soon as there is a preview of the image
+            avl.load_handles[image] = (
+                image.connect("finished-loading", self._image_loaded, avl),
+                image.connect("data-changed", self._image_previewed, avl)
+            )
+    
+    
+    def _image_previewed(self, image, avl):
+        if image.is_displayable:
+            self._image_loaded(image, None, avl)
     
     
     def _image_loaded(self, image, error, avl):
-        load_handle_id = avl.load_handles.pop(image, None)
-        if load_handle_id:
-            image.disconnect(load_handle_id)
+        load_handle_ids = avl.load_handles.pop(image, None)
+        if load_handle_ids:
+            for a_handle_id in load_handle_ids:
+                image.disconnect(a_handle_id)
             
         if image in avl.shown_images:
             self._refresh_frames(avl, image)
@@ -6,7 +6,8 @@
     The image loaders defined here are:
         PixbufDataImageSource: For already on memory GdkPixbuf objects
         PixbufFileImageSource: For GdkPixbuf supported files not on memory
-        PixbufAnimationFileImageSource: Anime adaptation of the above """
+        PixbufAnimationFileImageSource: Anime adaptation of the above
+        StreamedPixbufImageSource: For GdkPixbuf supported remote files """
 
 """ ...and this file is part of Pynorama.
     
@@ -24,12 +25,203 @@
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. """
 
 
+import cairo
+import math
+import os
+import tempfile
 import time
-from gi.repository import GdkPixbuf, Gio, GObject, GLib
+from gi.repository import Gdk, GdkPixbuf, Gio, GObject, GLib
 from gettext import gettext as _
-from pynorama import utility, loading, viewing
+from pynorama import caching, downloading, utility, loading, opening, viewing
 from pynorama.loading import Status
 
+# How many bytes are read from a file at a time while decoding it
+DECODING_CHUNK_SIZE = 64 * 1024
+
+# Minimum seconds between showing what has been decoded of an image so far
+PROGRESS_INTERVAL = 0.1
+
+
+def DecodeStream(stream, cancellable, size_prepared_cb=None, *data,
+                 progress=None):
+    """ Decodes a Gio.InputStream with a GdkPixbuf.PixbufLoader and returns
+        a pixbuf. The stream is closed afterwards.
+    
+    If size_prepared_cb is set it's connected to the loader "size-prepared"
+    signal with data as extra arguments so it can change the decoded size.
+    If a DecodingProgress is set it's connected to the loader as well.
+    This blocks, so it should be run in a worker.
+    
+    """
+    loader = GdkPixbuf.PixbufLoader()
+    if size_prepared_cb:
+        loader.connect("size-prepared", size_prepared_cb, *data)
+    if progress:
+        progress.connect(loader)
+    
+    closed = False
+    try:
+        while True:
+            chunk = stream.read_bytes(DECODING_CHUNK_SIZE, cancellable)
+            if not chunk.get_size():
+                break
+            
+            loader.write_bytes(chunk)
+        
+        closed = True
+        loader.close()
+        
+    finally:
+        stream.close(None)
+        if not closed:
+            try:
+                loader.close()
+            except GLib.GError:
+                pass
+    
+    return loader.get_pixbuf()
+
+
+def FitDisplayHint(loader, width, height, display_hint, image_sizes):
+    """ A PixbufLoader "size-prepared" callback
+    
+    It appends the image size to image_sizes and shrinks the decoded image
+    to what fits the display hint.
+    
+    """
+    image_sizes.append((width, height))
+    if display_hint:
+        view_size, rotation, zoom_mode = display_hint
+        rectangle = utility.Rectangle(0, 0, width, height)
+        rectangle = rectangle.spin(math.radians(rotation))
+        zoom = viewing.ZoomForSize(
+            view_size, (rectangle.width, rectangle.height), zoom_mode
+        )
+        if zoom < 1:
+            loader.set_size(
+                max(1, math.ceil(width * zoom)),
+                max(1, math.ceil(height * zoom))
+            )
+
+
+class DecodingProgress:
+    """ Paints what a GdkPixbuf.PixbufLoader has decoded so far into a surface
+    
+    The loader runs in a worker and paints the areas it updates into a
+    surface of its own which shares its pixels with .surface, the one used
+    from the main loop. While decoding goes on the callback is called from
+    the main loop with this object at most every PROGRESS_INTERVAL seconds.
+    
+    """
+    
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+        self.surface = None
+        # The size of the image before the loader was told to shrink it
+        self.image_size = None
+        # A thumbnail shown until the loader has something to show
+        self.thumbnail = None
+        
+        self._worker_surface = None
+        self._last_report = 0
+    
+    
+    def connect(self, loader):
+        loader.connect("size-prepared", self._size_prepared_cb)
+        loader.connect("area-prepared", self._area_prepared_cb)
+        loader.connect("area-updated", self._area_updated_cb)
+    
+    
+    def show_thumbnail(self, surface, image_size):
+        """ Shows a thumbnail of the image before anything is decoded,
+            and under the parts not decoded yet afterwards """
+        self.thumbnail = self.surface = surface
+        self.image_size = image_size
+        GLib.idle_add(self._report)
+    
+    
+    def finish(self):
+        """ Returns the surface with everything decoded. Runs in the worker """
+        if self._worker_surface:
+            self._worker_surface.flush()
+        
+        return self.surface
+    
+    
+    def _size_prepared_cb(self, loader, width, height):
+        self.image_size = width, height
+    
+    
+    def _area_prepared_cb(self, loader):
+        pixbuf = loader.get_pixbuf()
+        if pixbuf.get_has_alpha():
+            surface_format = cairo.FORMAT_ARGB32
+        else:
+            surface_format = cairo.FORMAT_RGB24
+        
+        width, height = pixbuf.get_width(), pixbuf.get_height()
+        stride = cairo.ImageSurface.format_stride_for_width(
+            surface_format, width
+        )
+        pixels = bytearray(stride * height)
+        self._worker_surface = cairo.ImageSurface.create_for_data(
+            pixels, surface_format, width, height, stride
+        )
+        if self.thumbnail:
+            cr = cairo.Context(self._worker_surface)
+            cr.scale(
+                width / self.thumbnail.get_width(),
+                height / self.thumbnail.get_height()
+            )
+            cr.set_source_surface(self.thumbnail, 0, 0)
+            cr.get_source().set_filter(cairo.FILTER_BILINEAR)
+            cr.paint()
+            self._worker_surface.flush()
+        
+        self.surface = cairo.ImageSurface.create_for_data(
+            pixels, surface_format, width, height, stride
+        )
+    
+    
+    def _area_updated_cb(self, loader, x, y, width, height):
+        if self._worker_surface is None or not width or not height:
+            return
+        
+        # Only the updated area is converted, not the whole pixbuf
+        area = loader.get_pixbuf().new_subpixbuf(x, y, width, height)
+        cr = cairo.Context(self._worker_surface)
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        Gdk.cairo_set_source_pixbuf(cr, area, x, y)
+        cr.rectangle(x, y, width, height)
+        cr.fill()
+        
+        now = time.monotonic()
+        if now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self._worker_surface.flush()
+            GLib.idle_add(self._report)
+    
+    
+    def _report(self):
+        if not self.cancelled:
+            # Let cairo know the pixels were changed behind its back
+            self.surface.mark_dirty()
+            self.callback(self)
+        
+        return False
+
+
+def SurfaceSourceMemoryUsage(source):
+    """ Returns the bytes used by a source .surface and its .pyramid """
+    result = 0
+    if source.surface:
+        result += utility.SurfaceMemoryUsage(source.surface)
+    if source.pyramid:
+        result += source.pyramid.get_memory_usage()
+    
+    return result
+
 
 class PixbufDataImageSource(loading.ImageSource):
     ''' An ImageSource created from a pixbuf
@@ -39,6 +231,9 @@ class PixbufDataImageSource(loading.ImageSource):
     def __init__(self, pixbuf, source=None):
         loading.ImageSource.__init__(self, source)
         self.surface = utility.SurfaceFromPixbuf(pixbuf)
+        self.pyramid = utility.SurfacePyramid(
+            self.surface, self._pyramid_ready_cb
+        )
         
         self.load_metadata()
         self.recacheable = False
@@ -53,11 +248,24 @@ class PixbufDataImageSource(loading.ImageSource):
         self.metadata.height = self.surface.get_height()
         self.metadata.modification_date = time.time()
         self.metadata.data_size = 0
+        self.metadata.is_complete = True
     
     
     def unload(self):
         self.surface = None
+        if self.pyramid:
+            self.pyramid.cancel()
+            self.pyramid = None
+        
         self.status = Status.UNLOADED
+    
+    
+    def get_memory_usage(self):
+        return SurfaceSourceMemoryUsage(self)
+    
+    
+    def _pyramid_ready_cb(self):
+        self.emit("data-changed")
         
         
     def create_frame(self):
@@ -73,6 +281,19 @@ class PixbufFileImageSource(loading.GFileImageSource):
     def __init__(self, file_source, **kwargs):
         loading.GFileImageSource.__init__(self, file_source, **kwargs)
         self.cancellable = None
+        self.surface = None
+        self.pyramid = None
+        # The actual width and height of the image, which may be larger
+        # than the surface when .is_reduced
+        self.image_size = None
+        
+        # Decoding and pixbuf to cairo surface conversion are done in a
+        # worker so that they don't block the interface
+        self._decoding_job = None
+        self._progress = None
+        self._upgrading_job = None
+        self._upgrading_cancellable = None
+        self._upgrading_failed = False
     
     
     def load(self):
@@ -80,43 +301,209 @@ class PixbufFileImageSource(loading.GFileImageSource):
             raise Exception
             
         self.cancellable = Gio.Cancellable()
+        self.status = Status.LOADING
+        self._progress = DecodingProgress(self._progressed)
+        self._decoding_job = utility.Workers.run(
+            self._decode, self.gfile, self.display_hint, self.cancellable,
+            self._progress,
+            callback=self._decoded, priority=self.load_priority
+        )
+    
+    
+    def prioritize(self, priority):
+        loading.GFileImageSource.prioritize(self, priority)
+        if self._decoding_job:
+            utility.Workers.reprioritize(self._decoding_job, priority)
+    
+    
+    def _progressed(self, progress):
+        """ Shows what has been decoded so far """
+        if progress is not self._progress or progress.image_size is None:
+            return
         
-        try:
-            stream = self.gfile.read(None)
-        except GLib.GError as gerror:
-            self.status = Status.UNLOADED
-            self.error = gerror
-            self.emit("finished-loading", self.error)
-        else:
-            self.status = Status.LOADING
-            GdkPixbuf.Pixbuf.new_from_stream_async(
-                stream, self.cancellable, self._loaded, None
-            )
+        # The surface changes from a thumbnail to the one being decoded
+        self.surface = progress.surface
+        self.image_size = progress.image_size
+        if self.metadata is None:
+            self.metadata = loading.ImageMeta()
+        self.metadata.width, self.metadata.height = self.image_size
+        self.has_preview = True
+        
+        self.emit("data-changed")
     
     
-    def _loaded(self, me, result, *data):
+    def _decoded(self, job):
+        self._decoding_job = None
+        self._progress = None
+        self.has_preview = False
         self.error = None
         try:
-            async_finish = GdkPixbuf.Pixbuf.new_from_stream_finish
-            pixbuf = async_finish(result)
-            self.surface = utility.SurfaceFromPixbuf(pixbuf)
-
-        except GLib.GError as gerror:
-            # .unload() sets cancellable to None, so if it's None we assume
-            # the loading has been cancelled and the error is because of that
-            if self.cancellable:
-                self.status = Status.UNLOADED
-                self.error = gerror
+            self.surface, self.image_size, thumbnail = job.finish()
+            
+        except Exception as e:
+            self.surface = None
+            self.status = Status.UNLOADED
+            self.error = e
             
         else:
+            # The surface might have been shown while it was being decoded
+            self.surface.mark_dirty()
+            self.pyramid = utility.SurfacePyramid(
+                self.surface, self._pyramid_ready_cb
+            )
+            width, height = self.image_size
+            self.is_reduced = (
+                self.surface.get_width() < width
+                or self.surface.get_height() < height
+            )
+            self._upgrading_failed = False
             self.status = Status.LOADED
             self.load_metadata()
+            if thumbnail:
+                # Writing thumbnails is left for after the image is shown
+                utility.Workers.run(
+                    caching.Thumbnails.store, *thumbnail,
+                    priority=GLib.PRIORITY_LOW
+                )
             
         finally:
             self.cancellable = None
             self.emit("finished-loading", self.error)
     
     
+    def request_full_resolution(self):
+        if (self.is_loaded and self.is_reduced
+                and not self._upgrading_job and not self._upgrading_failed):
+            self._upgrading_cancellable = Gio.Cancellable()
+            self._upgrading_job = utility.Workers.run(
+                self._decode, self.gfile, None, self._upgrading_cancellable,
+                callback=self._upgraded, priority=GLib.PRIORITY_LOW
+            )
+    
+    
+    def _upgraded(self, job):
+        self._upgrading_job = None
+        self._upgrading_cancellable = None
+        try:
+            surface, image_size, thumbnail = job.finish()
+        except Exception:
+            # Not much to do about it, the reduced surface will have to do
+            self._upgrading_failed = True
+        else:
+            self.pyramid.cancel()
+            self.surface = surface
+            self.pyramid = utility.SurfacePyramid(
+                surface, self._pyramid_ready_cb
+            )
+            self.is_reduced = False
+            self.emit("data-changed")
+    
+    
+    def _pyramid_ready_cb(self):
+        self.emit("data-changed")
+    
+    
+    def get_memory_usage(self):
+        return SurfaceSourceMemoryUsage(self)
+    
+    
+    def _decode(self, gfile, display_hint, cancellable, progress=None):
+        """ Decodes the image into a surface. Runs in a worker.
+        
+        Returns a (surface, image size, thumbnail) tuple. If a display hint
+        is given or the image is too large the surface might be smaller
+        than the image size. If a DecodingProgress is given the surface is
+        the one it painted while decoding. thumbnail is the arguments for
+        caching.Thumbnails.store if the file had no thumbnail, with the
+        pixbuf already shrunk to thumbnail size, or None.
+        
+        """
+        thumbnail_key = None
+        if progress:
+            thumbnail_key = self._show_thumbnail(gfile, cancellable, progress)
+        
+        pixbuf, surface, image_size = self._decode_stream(
+            gfile.read(cancellable), display_hint, cancellable, progress
+        )
+        thumbnail = None
+        if thumbnail_key:
+            # Only what is written is kept until the thumbnail is stored
+            thumbnail = thumbnail_key + (
+                caching.Thumbnails.shrink(pixbuf), image_size
+            )
+        
+        return surface, image_size, thumbnail
+    
+    
+    @staticmethod
+    def _decode_stream(stream, display_hint, cancellable, progress):
+        """ Decodes the image in a stream. Runs in a worker.
+            Returns a (pixbuf, surface, image size) tuple """
+        image_sizes = []
+        pixbuf = DecodeStream(
+            stream, cancellable,
+            FitDisplayHint, display_hint, image_sizes,
+            progress=progress
+        )
+        surface = progress.finish() if progress else None
+        if surface is None:
+            surface = utility.SurfaceFromPixbuf(pixbuf)
+        
+        if image_sizes:
+            image_size = image_sizes[0]
+        else:
+            image_size = surface.get_width(), surface.get_height()
+        
+        return pixbuf, surface, image_size
+    
+    
+    @staticmethod
+    def _show_thumbnail(gfile, cancellable, progress):
+        """ Shows the cached thumbnail of a file while it's being decoded
+        
+        Returns the (uri, modification time, size) of the file if it has
+        no up to date thumbnail and one should be stored once it's decoded.
+        Downloads and temporary files never get thumbnails.
+        Runs in a worker.
+        
+        """
+        thumbnails = caching.Thumbnails
+        if thumbnails.is_thumbnail(gfile) or IsTemporaryFile(gfile):
+            return None
+        
+        try:
+            file_info = gfile.query_info(
+                "standard::size,time::modified", 0, cancellable
+            )
+        except GLib.GError:
+            return None
+        
+        if not file_info.has_attribute("time::modified"):
+            return None
+        
+        uri = gfile.get_uri()
+        mtime = file_info.get_attribute_uint64("time::modified")
+        size = file_info.get_size()
+        found = thumbnails.lookup(uri, mtime, size)
+        if found is None:
+            return uri, mtime, size
+        
+        pixbuf, image_size = found
+        if image_size is None and gfile.is_native():
+            fmt, width, height = GdkPixbuf.Pixbuf.get_file_info(
+                gfile.get_path()
+            )
+            if fmt:
+                image_size = width, height
+        
+        if image_size:
+            progress.show_thumbnail(
+                utility.SurfaceFromPixbuf(pixbuf), image_size
+            )
+        
+        return None
+    
+    
     def unload(self):
         self.status = Status.UNLOADING
         
@@ -124,7 +511,27 @@ class PixbufFileImageSource(loading.GFileImageSource):
             self.cancellable.cancel()
             self.cancellable = None
         
+        if self._decoding_job:
+            self._decoding_job.cancel()
+            self._decoding_job = None
+        
+        if self._progress:
+            self._progress.cancelled = True
+            self._progress = None
+        
+        if self._upgrading_job:
+            self._upgrading_job.cancel()
+            self._upgrading_job = None
+            self._upgrading_cancellable.cancel()
+            self._upgrading_cancellable = None
+        
+        if self.pyramid:
+            self.pyramid.cancel()
+            self.pyramid = None
+        
         self.surface = None
+        self.is_reduced = False
+        self.has_preview = False
         self.status = Status.UNLOADED
     
     
@@ -156,22 +563,18 @@ class PixbufFileImageSource(loading.GFileImageSource):
                 self.metadata.modification_date = float(time.time())
         
         # The width and height of the image are loaded from guess where
-        if self.surface:
-            self.metadata.width = self.surface.get_width()
-            self.metadata.height = self.surface.get_height()
+        if self.image_size:
+            self.metadata.width, self.metadata.height = self.image_size
             
-        elif self.gfile.is_native():
+        else:
             try:
-                filepath = self.gfile.get_path()
-                fmt, width, height = GdkPixbuf.Pixbuf.get_file_info(filepath)
-                self.metadata.width = width
-                self.metadata.height = height
-                
+                size = loading.ReadImageSize(self.gfile)
             except Exception:
-                self.metadata.width = 0
-                self.metadata.height = 0
+                size = 0, 0
             
-        # TODO: Add support for non-native files
+            self.metadata.width, self.metadata.height = size
+        
+        self.metadata.is_complete = True
     
     
     def create_frame(self):
@@ -183,6 +586,213 @@ class PixbufFileImageSource(loading.GFileImageSource):
         clipboard.set_image(pixbuf)
     
     
+class StreamedPixbufImageSource(PixbufFileImageSource):
+    """ A PixbufFileImageSource for a remote file not downloaded yet
+    
+    The first time it's loaded the file at .uri is decoded while it's
+    downloaded, so it can be seen before the download is over, and the
+    downloaded bytes are written to a file in the download cache as they
+    are decoded. Once that is done the file source file is moved there
+    and it's decoded like any other file from then on.
+    
+    If given the caching.DownloadCache.Record of an outdated copy, the
+    first load asks whether the file changed instead, and downloads it
+    before decoding it only if it did.
+    
+    The download waits for its turn in downloading.Downloads at the
+    .load_priority of the image, and follows .prioritize() like decoding
+    does, so the image the user is looking at downloads first.
+    
+    """
+    
+    def __init__(self, file_source, uri, suffix="", record=None, **kwargs):
+        PixbufFileImageSource.__init__(self, file_source, **kwargs)
+        self.uri = uri
+        self.suffix = suffix
+        self.record = record
+        self.is_downloaded = False
+        
+        self._download_path = None
+        self._validators = None, None
+        # The downloading.Download this waits on or reads
+        self._stream = None
+    
+    
+    def load(self):
+        if self.is_downloaded:
+            PixbufFileImageSource.load(self)
+            return
+        
+        if self.is_loading:
+            raise Exception
+        
+        self._download_path = caching.DownloadedFiles.get_download_path()
+        if self._download_path is None:
+            file_descriptor, self._download_path = tempfile.mkstemp(
+                suffix=self.suffix
+            )
+            os.close(file_descriptor)
+        
+        self.cancellable = Gio.Cancellable()
+        self.status = Status.LOADING
+        if self.record:
+            self._stream = downloading.Downloads.download(
+                self.uri, self._download_path, self._revalidated_cb,
+                priority=self.load_priority,
+                etag=self.record.etag, modified=self.record.modified
+            )
+            return
+        
+        self._progress = DecodingProgress(self._progressed)
+        self._stream = downloading.Downloads.stream(
+            self.uri, self._stream_started_cb, priority=self.load_priority
+        )
+    
+    
+    def _revalidated_cb(self, download):
+        self._stream = None
+        path, self._download_path = self._download_path, None
+        if download.unchanged or download.error:
+            RemoveFile(path)
+            if download.unchanged:
+                caching.DownloadedFiles.revalidate(self.uri)
+            
+            # An outdated copy is still better than nothing
+            self.is_downloaded = True
+        else:
+            self._keep_download(path, download.etag, download.modified)
+        
+        self.status = Status.UNLOADED
+        PixbufFileImageSource.load(self)
+    
+    
+    def _stream_started_cb(self, stream):
+        # Downloads have workers of their own so that waiting on the
+        # network doesn't hold up decoding local files
+        self._decoding_job = downloading.StreamWorkers.run(
+            self._download, self._download_path, self.display_hint,
+            self.cancellable, self._progress,
+            callback=self._decoded, priority=self.load_priority
+        )
+    
+    
+    def prioritize(self, priority):
+        if self.is_downloaded:
+            PixbufFileImageSource.prioritize(self, priority)
+            return
+        
+        loading.GFileImageSource.prioritize(self, priority)
+        if self._stream:
+            downloading.Downloads.prioritize(self._stream, priority)
+        
+        if self._decoding_job:
+            downloading.StreamWorkers.reprioritize(
+                self._decoding_job, priority
+            )
+    
+    
+    def read_metadata(self):
+        # Until it's downloaded there's no file to read it from, and
+        # it's read again once there is
+        if self.is_downloaded or self.record:
+            return PixbufFileImageSource.read_metadata(self)
+        else:
+            return None
+    
+    
+    def _download(self, path, display_hint, cancellable, progress):
+        """ Decodes the remote file while writing it to a path.
+            Runs in a worker. """
+        stream = Gio.File.new_for_uri(self.uri).read(cancellable)
+        try:
+            info = stream.query_info(
+                downloading.VALIDATOR_ATTRIBUTES, cancellable
+            )
+        except GLib.GError:
+            pass
+        else:
+            self._validators = downloading.ReadValidators(info)
+        
+        with open(path, "wb") as download_file:
+            pixbuf, surface, image_size = self._decode_stream(
+                downloading.CopyingStream(stream, download_file),
+                display_hint, cancellable, progress
+            )
+        
+        return surface, image_size, None
+    
+    
+    def _decoded(self, job):
+        if self._stream:
+            downloading.Downloads.release(self._stream)
+            self._stream = None
+        
+        if not self.is_downloaded:
+            path, self._download_path = self._download_path, None
+            if job.error is None:
+                self._keep_download(path, *self._validators)
+            else:
+                RemoveFile(path)
+        
+        PixbufFileImageSource._decoded(self, job)
+    
+    
+    def _keep_download(self, path, etag, modified):
+        stored_path = caching.DownloadedFiles.store(
+            self.uri, path, self.suffix, etag, modified
+        )
+        if self.file_source.cache:
+            # Releases the outdated copy this replaces
+            self.file_source.cache.uncache()
+        
+        if stored_path is None:
+            # Kept until the session ends, like other downloads
+            stored_path = path
+            self.file_source.cache = opening.FileCache([path])
+        else:
+            self.file_source.cache = opening.DownloadedFileCache(stored_path)
+        
+        self.gfile = Gio.File.new_for_path(stored_path)
+        self.file_source.gfile = self.gfile
+        self.is_downloaded = True
+        loading.Metadata.request(self)
+    
+    
+    def unload(self):
+        PixbufFileImageSource.unload(self)
+        if self._stream:
+            downloading.Downloads.release(self._stream)
+            self._stream = None
+        
+        if self._download_path:
+            # The download was cancelled halfway through
+            RemoveFile(self._download_path)
+            self._download_path = None
+
+
+def IsTemporaryFile(gfile):
+    """ Whether a file is a download or some other temporary file """
+    path = gfile.get_path()
+    if not path:
+        return False
+    
+    path = os.path.abspath(path)
+    return any(
+        path.startswith(os.path.join(os.path.abspath(a_directory), ""))
+        for a_directory in (
+            caching.DownloadedFiles.directory, tempfile.gettempdir()
+        )
+    )
+
+
+def RemoveFile(path):
+    """ Removes a file if it's there """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 class PixbufAnimationFileImageSource(loading.GFileImageSource):
     def __init__(self, file_source, **kwargs):
         loading.GFileImageSource.__init__(self, file_source, **kwargs)
@@ -270,18 +880,15 @@ class PixbufAnimationFileImageSource(loading.GFileImageSource):
             self.metadata.width = self.pixbuf_animation.get_width()
             self.metadata.height = self.pixbuf_animation.get_height()
             
-        elif self.gfile.is_native():
+        else:
             try:
-                filepath = self.gfile.get_path()
-                fmt, width, height = GdkPixbuf.Pixbuf.get_file_info(filepath)
-                self.metadata.width = width
-                self.metadata.height = height
-                
+                size = loading.ReadImageSize(self.gfile)
             except Exception:
-                self.metadata.width = 0
-                self.metadata.height = 0
+                size = 0, 0
             
-        # TODO: Add support for non-native files
+            self.metadata.width, self.metadata.height = size
+        
+        self.metadata.is_complete = True
     
     
     def create_frame(self):
@@ -25,19 +25,33 @@
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. """
 
 
+import hashlib
 import os 
 from os import path as os_path
 import tempfile
+import time
+from collections import OrderedDict
 from gettext import gettext as _
 from urllib.parse import urlparse
 
 from gi.repository import Gdk, GdkPixbuf, Gio, GLib, GObject, Gtk
 
-from pynorama import extending, opening
+from pynorama import caching, extending, opening, utility
 from pynorama.extending import Opener, OpenerGuesser, SelectionOpener
 from pynorama.opening import GFileSource, URISource, SelectionSource
 from . import loaders
 
+# How many children of a directory are listed at a time
+DIRECTORY_BATCH_SIZE = 500
+# How many files a directory scan finds before handing them over
+SCAN_BATCH_SIZE = 500
+# Directories with fewer entries than this are listed again every time
+# instead of having their listing cached
+LISTING_CACHE_THRESHOLD = 256
+# For how many seconds a downloaded file is reused without asking the
+# server whether it has changed
+DOWNLOAD_FRESHNESS = 60 * 60
+
 class GFileOpener:
     """ An interface to open files for the image viewer.
     
@@ -82,12 +96,87 @@ class GFileOpener:
         return self._file_filter
 
 
+class GFileOpenerIndex:
+    """ Looks up which of a sequence of GFileOpeners opens a file
+    
+    Openers are indexed by lower-cased extension and by mime type. Earlier
+    openers in the sequence have priority over later ones, like in the
+    loop over their file filters this replaces. File names and types
+    that are not in the index are matched against the file filters once,
+    and the result is remembered.
+    
+    """
+    
+    def __init__(self, openers):
+        self.openers = openers
+        self.by_extension, self.by_mime_type = {}, {}
+        for a_priority, an_opener in enumerate(openers):
+            for an_extension in an_opener.extensions:
+                self.by_extension.setdefault(
+                    an_extension.lstrip(".").lower(), (a_priority, an_opener)
+                )
+            
+            for a_mime_type in an_opener.mime_types:
+                self.by_mime_type.setdefault(
+                    a_mime_type, (a_priority, an_opener)
+                )
+        
+        self._filtered = {}
+    
+    
+    def lookup(self, display_name, content_type):
+        """ Returns the opener for a file or None if there is none """
+        extension = os_path.splitext(display_name)[1][1:].lower()
+        found = []
+        if extension in self.by_extension:
+            found.append(self.by_extension[extension])
+        
+        if content_type:
+            if content_type in self.by_mime_type:
+                found.append(self.by_mime_type[content_type])
+            else:
+                mime_type = Gio.content_type_get_mime_type(content_type)
+                if mime_type in self.by_mime_type:
+                    found.append(self.by_mime_type[mime_type])
+        
+        if found:
+            return min(found, key=lambda entry: entry[0])[1]
+        
+        # e.g. mime types that are a subclass of a supported one
+        key = extension, content_type
+        try:
+            return self._filtered[key]
+        except KeyError:
+            result = self._filter(display_name, content_type)
+            self._filtered[key] = result
+            return result
+    
+    
+    def _filter(self, display_name, content_type):
+        flags = Gtk.FileFilterFlags
+        gfile_filter_info = Gtk.FileFilterInfo()
+        gfile_filter_info.contains = flags.DISPLAY_NAME | flags.MIME_TYPE
+        gfile_filter_info.display_name = display_name
+        gfile_filter_info.mime_type = content_type
+        
+        for an_opener in self.openers:
+            if an_opener.get_file_filter().filter(gfile_filter_info):
+                return an_opener
+        else:
+            return None
+
+
 class GFileOpenerGuesser(OpenerGuesser):
     CODENAME = "gfile"
+    
+    # How many GFileOpenerIndex are kept around
+    INDEX_LIMIT = 8
+    
     def __init__(self):
         OpenerGuesser.__init__(self,
                                GFileOpenerGuesser.CODENAME,
                                GFileSource.KIND)
+        self._indices = OrderedDict()
     
     
     def guess(self, source, openers):
@@ -95,19 +184,20 @@ class GFileOpenerGuesser(OpenerGuesser):
         # added last have higher priority and may "override" how certain
         # types of files are opened
         
-        gfile_info = source.info
-        
-        flags = Gtk.FileFilterFlags
-        gfile_filter_info = Gtk.FileFilterInfo()
-        gfile_filter_info.contains = flags.DISPLAY_NAME | flags.MIME_TYPE
-        gfile_filter_info.display_name = gfile_info.get_display_name()
-        gfile_filter_info.mime_type = gfile_info.get_content_type()
+        # Sessions mostly share the same openers, so their index is
+        # built once and used for every file opened with them
+        openers = tuple(openers)
+        try:
+            index = self._indices[openers]
+        except KeyError:
+            index = self._indices[openers] = GFileOpenerIndex(openers)
+            if len(self._indices) > GFileOpenerGuesser.INDEX_LIMIT:
+                self._indices.popitem(last=False)
         
-        for an_opener in openers:
-            if an_opener.get_file_filter().filter(gfile_filter_info):
-                return an_opener
-        else:
-            return None
+        gfile_info = source.info
+        return index.lookup(
+            gfile_info.get_display_name(), gfile_info.get_content_type()
+        )
 
 
 # TODO define this interface
@@ -131,15 +221,165 @@ class URIOpenerGuesser(OpenerGuesser):
         return None
 
 
+class DirectoryScan:
+    """ Walks a local directory tree with os.scandir in a worker
+    
+    Only files whose extension or guessed content type some opener
+    supports are kept. They are handed over to the main loop in batches
+    of about SCAN_BATCH_SIZE files through the callback, as a list of
+    (directory path, [(file name, content type), ...]) tuples.
+    
+    The subdirectories of a directory are walked if it is less than
+    free_levels deep or it has at most image_count_threshold files kept,
+    which is how OpeningHandler decides whether to go deeper.
+    
+    The walk stops early if the cancellable is cancelled. Listings of
+    large directories are kept in caching.DirectoryListings and reused
+    while the directories aren't modified.
+    
+    """
+    
+    def __init__(self, path, extensions, mime_types, callback,
+                 free_levels=0, image_count_threshold=0, cancellable=None):
+        self.path = path
+        self.extensions = extensions
+        self.mime_types = mime_types
+        self.callback = callback
+        self.free_levels = free_levels
+        self.image_count_threshold = image_count_threshold
+        self.cancellable = cancellable
+        # Tells listings apart by which files were kept
+        self.listing_key = hashlib.sha1("\n".join([
+            ",".join(sorted(extensions)), ",".join(sorted(mime_types))
+        ]).encode("utf-8")).hexdigest()
+        
+        self._batch = []
+        self._batch_size = 0
+    
+    
+    def run(self):
+        """ Walks the directory tree. This is run in a worker """
+        try:
+            self._walk()
+        finally:
+            caching.DirectoryListings.commit()
+    
+    
+    def _walk(self):
+        walked = set()
+        stack = [(self.path, 0)]
+        while stack:
+            if self.cancellable and self.cancellable.is_cancelled():
+                return
+            
+            directory, level = stack.pop()
+            try:
+                stat = os.stat(directory)
+                # Symbolic links could lead around in circles
+                key = stat.st_dev, stat.st_ino
+                if key in walked:
+                    continue
+                
+                walked.add(key)
+                files, subdirectories = self._list(
+                    directory, stat.st_mtime_ns
+                )
+                
+            except OSError:
+                if level == 0:
+                    raise
+                
+                continue
+            
+            if files:
+                self._batch.append((directory, files))
+                self._batch_size += len(files)
+                if self._batch_size >= SCAN_BATCH_SIZE:
+                    self._post()
+            
+            if level < self.free_levels or \
+               len(files) <= self.image_count_threshold:
+                # Popped in alphabetical order
+                subdirectories.sort(reverse=True)
+                stack.extend((a_path, level + 1) for a_path in subdirectories)
+        
+        self._post()
+    
+    
+    def _list(self, directory, mtime):
+        listings = caching.DirectoryListings
+        found = listings.lookup(directory, self.listing_key, mtime)
+        if found is not None:
+            files, subdirectory_names = found
+        else:
+            files, subdirectory_names = [], []
+            entry_count = 0
+            with os.scandir(directory) as entries:
+                for an_entry in entries:
+                    entry_count += 1
+                    try:
+                        is_directory = an_entry.is_dir()
+                    except OSError:
+                        continue
+                    
+                    if is_directory:
+                        subdirectory_names.append(an_entry.name)
+                    else:
+                        content_type = self._classify(an_entry.name)
+                        if content_type:
+                            files.append((an_entry.name, content_type))
+            
+            if entry_count >= LISTING_CACHE_THRESHOLD:
+                listings.store(
+                    directory, self.listing_key, mtime,
+                    files, subdirectory_names
+                )
+        
+        subdirectories = [
+            os_path.join(directory, a_name) for a_name in subdirectory_names
+        ]
+        return files, subdirectories
+    
+    
+    def _classify(self, name):
+        """ Returns the content type guessed for a file name
+            or None if no opener seems to support it """
+        content_type, uncertain = Gio.content_type_guess(name, None)
+        extension = os_path.splitext(name)[1][1:].lower()
+        if extension in self.extensions:
+            return content_type
+        
+        mime_type = Gio.content_type_get_mime_type(content_type)
+        if mime_type in self.mime_types:
+            return content_type
+        
+        return None
+    
+    
+    def _post(self):
+        if self._batch:
+            GLib.idle_add(
+                self.callback, self._batch, priority=GLib.PRIORITY_LOW
+            )
+            self._batch, self._batch_size = [], 0
+
+
 class DirectoryOpener(Opener, GFileOpener):
-    """ Opens directories and yields the files inside them """
+    """ Opens directories and yields the files inside them
+    
+    Local directories are walked recursively in a worker when an app is
+    set, following the same thresholds as the app OpeningHandler.
+    Otherwise their children are listed and opened one level at a time.
+    
+    """
     
     CODENAME = "directory"
     
-    def __init__(self):
+    def __init__(self, app=None):
         Opener.__init__(self, DirectoryOpener.CODENAME, GFileSource.KIND)
         GFileOpener.__init__(self, mime_types={"inode/directory"})
         self.show_on_dialog = False
+        self.app = app
     
     
     @GObject.Property
@@ -150,11 +390,16 @@ class DirectoryOpener(Opener, GFileOpener):
     def open_file_source(self, context, results, source):
         """ Opens a directory file and yields its contents """
         
+        path = source.gfile.get_path()
+        if path and self.app:
+            self._scan(context, results, source, path)
+            return
+        
         source.gfile.enumerate_children_async(
             opening.STANDARD_GFILE_INFO_STRING,
             0,
             GLib.PRIORITY_DEFAULT,
-            None,
+            context.cancellable,
             self._enumerate_children_async_cb,
             (context, results, source)
         )
@@ -162,41 +407,164 @@ class DirectoryOpener(Opener, GFileOpener):
     
     def _enumerate_children_async_cb(self, gfile, async_result, data):
         context, results, source = data
-        gfile = source.gfile
         try:
             gfile_enumerator = gfile.enumerate_children_finish(async_result)
         except Exception as e:
             results.errors.append(e)
+            results.complete()
         else:
-            get_child_for_display_name = gfile.get_child_for_display_name
-            append_source = results.sources.append
-            file_source = opening.GFileSource
-            
-            for a_file_info in gfile_enumerator:
-                try:
-                    child_name = a_file_info.get_display_name()
-                    a_child_file = get_child_for_display_name(child_name)
-                    a_file_source = file_source(
-                        a_child_file, name=child_name, parent=source
-                    )
-                    a_file_source.info = a_file_info
-                    append_source(a_file_source)
-                    
-                except Exception as e:
-                    results.errors.append(e)
-                
+            self._next_files(gfile_enumerator, data)
+    
+    
+    def _next_files(self, gfile_enumerator, data):
+        context, results, source = data
+        gfile_enumerator.next_files_async(
+            DIRECTORY_BATCH_SIZE,
+            GLib.PRIORITY_DEFAULT,
+            context.cancellable,
+            self._next_files_async_cb,
+            data
+        )
+    
+    
+    def _next_files_async_cb(self, gfile_enumerator, async_result, data):
+        """ Hands over a batch of the directory children and asks for the
+            next one, or completes the results if there are no more """
+        context, results, source = data
+        try:
+            file_infos = gfile_enumerator.next_files_finish(async_result)
+        except Exception as e:
+            results.errors.append(e)
+            file_infos = None
+        
+        if not file_infos:
             gfile_enumerator.close_async(
                 GLib.PRIORITY_DEFAULT,
                 None,
                 self._close_async_cb,
                 None
             )
-        finally:
             results.complete()
+            return
+        
+        get_child_for_display_name = source.gfile.get_child_for_display_name
+        file_source = opening.GFileSource
+        
+        new_sources = []
+        for a_file_info in file_infos:
+            try:
+                child_name = a_file_info.get_display_name()
+                a_child_file = get_child_for_display_name(child_name)
+                a_file_source = file_source(
+                    a_child_file, name=child_name, parent=source
+                )
+                a_file_source.info = a_file_info
+                new_sources.append(a_file_source)
+                
+            except Exception as e:
+                results.errors.append(e)
+        
+        results.add_sources(new_sources)
+        self._next_files(gfile_enumerator, data)
     
     
     def _close_async_cb(self, enumerator, async_result, *etc):
         enumerator.close_finish(async_result)
+    
+    
+    def _scan(self, context, results, source, path):
+        """ Starts walking a local directory in a worker """
+        extensions, mime_types = set(), set()
+        for an_opener in self.app.components[Opener.CATEGORY]:
+            if an_opener is not self and isinstance(an_opener, GFileOpener):
+                extensions.update(
+                    an_extension.lstrip(".").lower()
+                    for an_extension in an_opener.extensions
+                )
+                mime_types.update(an_opener.mime_types)
+        
+        # The files found in the directory are opened in a session one
+        # level deeper than this source's, and so on
+        handler = self.app.opener
+        depth = len(list(source.get_ancestors()))
+        
+        state = DirectoryOpener.ScanningState(context, results, source, path)
+        scan = DirectoryScan(
+            path, extensions, mime_types,
+            callback=lambda batch: self._scanned_batch_cb(batch, state),
+            free_levels=handler.warning_depth_threshold - depth - 1,
+            image_count_threshold=handler.warning_image_count_threshold,
+            cancellable=state.cancellable
+        )
+        utility.Workers.run(
+            scan.run, callback=lambda job: self._scanned_cb(job, state),
+            priority=GLib.PRIORITY_LOW
+        )
+    
+    
+    class ScanningState:
+        def __init__(self, context, results, source, path):
+            self.context = context
+            self.cancellable = context.cancellable
+            self.results = results
+            self.directories = {path: source}
+    
+    
+    def _scanned_batch_cb(self, batch, state):
+        """ Creates file sources for a batch of files found scanning """
+        if state.cancellable.is_cancelled():
+            return False
+        
+        file_source = opening.GFileSource
+        new_file_info = Gio.FileInfo.new
+        regular_type = Gio.FileType.REGULAR
+        threshold = self.app.opener.warning_file_count_threshold
+        
+        new_sources = []
+        for a_directory, some_files in batch:
+            if len(some_files) >= threshold:
+                opening.logger.log(
+                    "File count exceeded warning threshold in %s" % a_directory
+                )
+            
+            parent = self._get_directory_source(state, a_directory)
+            for a_name, a_content_type in some_files:
+                a_file_info = new_file_info()
+                a_file_info.set_display_name(a_name)
+                a_file_info.set_file_type(regular_type)
+                a_file_info.set_content_type(a_content_type)
+                
+                a_path = os_path.join(a_directory, a_name)
+                a_file = Gio.File.new_for_path(a_path)
+                a_file_source = file_source(a_file, name=a_name, parent=parent)
+                a_file_source.info = a_file_info
+                new_sources.append(a_file_source)
+        
+        state.results.add_sources(new_sources)
+        return False
+    
+    
+    def _get_directory_source(self, state, path):
+        """ Returns the source of a scanned directory, creating it and
+            those of its parent directories if needed """
+        result = state.directories.get(path)
+        if result is None:
+            parent = self._get_directory_source(state, os_path.dirname(path))
+            name = os_path.basename(path)
+            result = opening.GFileSource(
+                Gio.File.new_for_path(path), name=name, parent=parent
+            )
+            result.link_parent()
+            state.directories[path] = result
+        
+        return result
+    
+    
+    def _scanned_cb(self, job, state):
+        if job.error is not None:
+            state.results.errors.append(job.error)
+        
+        state.results.complete()
 
 
 class PixbufOpener(Opener, SelectionOpener, GFileOpener):
@@ -234,7 +602,7 @@ class PixbufOpener(Opener, SelectionOpener, GFileOpener):
     def open_file_source(self, context, results, source):
         if source.KIND == GFileSource.KIND:
             new_image = loaders.PixbufFileImageSource(source)
-            results.images.append(new_image)
+            results.add_images([new_image])
         
         results.complete()
     
@@ -249,7 +617,7 @@ class PixbufOpener(Opener, SelectionOpener, GFileOpener):
         source.setImageContentName()
         
         image_source = loaders.PixbufDataImageSource(pixbuf, source)
-        results.images.append(image_source)
+        results.add_images([image_source])
         
         results.complete()
 
@@ -280,20 +648,27 @@ class PixbufAnimationFileOpener(Opener, GFileOpener):
         except Exception as e:
             results.errors.append(e)
         else:
-            results.images.append(new_image)
+            results.add_images([new_image])
             
         results.complete()
 
 
 class URICacheFallbackOpener(Opener, URIOpener):
-    """ Downloads URIs into the cache and returns GFiles to open them """
+    """ Downloads URIs into the cache and returns GFiles to open them
+    
+    URIs whose extension is in stream_extensions are opened as images
+    right away instead, which are downloaded or revalidated once they are
+    loaded, so that their downloads follow their load priority.
+    
+    """
     CODENAME = "uri-cache"
     
-    def __init__(self):
+    def __init__(self, stream_extensions=None):
         Opener.__init__(self,
                         URICacheFallbackOpener.CODENAME,
                         GFileSource.KIND)
         URIOpener.__init__(self)
+        self.stream_extensions = stream_extensions or set()
     
     
     @GObject.Property
@@ -302,7 +677,16 @@ class URICacheFallbackOpener(Opener, URIOpener):
     
     
     def open_file_source(self, context, results, source):
-        state = URICacheFallbackOpener.CachingState(context, results, source)
+        # Files downloaded in previous sessions are reused if the server
+        # says they haven't changed, or without asking if that was
+        # asked recently
+        record = caching.DownloadedFiles.lookup(source.uri)
+        if record and time.time() - record.validated < DOWNLOAD_FRESHNESS:
+            results.add_sources([
+                self._create_cached_source(record.path, source)
+            ])
+            results.complete()
+            return
         
         # Get extension from URI
         suffix = ""
@@ -312,87 +696,86 @@ class URICacheFallbackOpener(Opener, URIOpener):
             if "/" not in after_dot_split:
                 suffix = "." + after_dot_split
         
-        file_descriptor, state.cache_path = tempfile.mkstemp(
-           dir=context.cache_directory, suffix=suffix)
-        
-        os.close(file_descriptor) # won't need this open... probably
+        if suffix[1:].lower() in self.stream_extensions:
+            if record:
+                file_source = self._create_cached_source(record.path, source)
+            else:
+                file_source = self._create_source(
+                    caching.DownloadedFiles.get_path(source.uri, suffix),
+                    source
+                )
+            
+            new_image = loaders.StreamedPixbufImageSource(
+                file_source, source.uri, suffix, record
+            )
+            results.add_images([new_image])
+            results.complete()
+            return
         
-        state.files = [
-            Gio.File.new_for_uri(source.uri),
-            Gio.File.new_for_path(state.cache_path)
-        ]
-        state.cancellables = [Gio.Cancellable(), Gio.Cancellable()]
+        download_path = caching.DownloadedFiles.get_download_path()
+        if download_path is None:
+            file_descriptor, download_path = tempfile.mkstemp(
+               dir=context.cache_directory, suffix=suffix)
+            
+            os.close(file_descriptor) # won't need this open... probably
         
-        state.files[0].read_async(
-            GLib.PRIORITY_DEFAULT,
-            state.cancellables[0],
-            self._async_cb,
-            (True, state)
-        )
-        state.files[1].append_to_async(
-            Gio.FileCreateFlags.REPLACE_DESTINATION,
-            GLib.PRIORITY_DEFAULT,
-            state.cancellables[1],
-            self._async_cb,
-            (False, state)
+        context.download(
+            source, download_path, self._downloaded_cb,
+            results, source, record, suffix,
+            etag=record.etag if record else None,
+            modified=record.modified if record else None
         )
     
     
-    class CachingState:
-        def __init__(self, context, results, source):
-            self.context = context
-            self.results = results
-            self.source = source
-            self.streams = [None, None]
-            self.cancelled = False
-    
-    
-    def _async_cb(self, gfile, result, data):
-        uri_version, state = data
-        this, other = (0, 1) if uri_version else (1, 0)
-        
-        try:
-            if uri_version:
-                stream = gfile.read_finish(result)
-            else:
-                stream = gfile.append_to_finish(result)
-        except Exception as e:
-            if not state.cancelled:
-                state.cancelled = True
-                state.cancellables[other].cancel()
+    def _downloaded_cb(self, download, results, source, record, suffix):
+        if download.unchanged or download.error:
+            try:
+                os.remove(download.path)
+            except OSError:
+                pass
+            
+            if record:
+                # An outdated copy is still better than nothing
+                if download.unchanged:
+                    caching.DownloadedFiles.revalidate(source.uri)
                 
-                state.results.errors.append(e)
-                state.results.complete()
+                result = self._create_cached_source(record.path, source)
+                results.add_sources([result])
+            else:
+                results.errors.append(download.error)
+        
         else:
-            state.streams[this] = stream
-            if state.streams[other]:
-                state.splice_cancellable = Gio.Cancellable()
-                state.streams[1].splice_async(
-                    state.streams[0],
-                    (Gio.OutputStreamSpliceFlags.CLOSE_SOURCE |
-                     Gio.OutputStreamSpliceFlags.CLOSE_TARGET),
-                    GLib.PRIORITY_LOW,
-                    state.splice_cancellable,
-                    self._splice_cb,
-                    state
-                )
-                uri_stream = state.streams[0]
-        finally:
-            state.cancellables[this] = None
+            cached_path = caching.DownloadedFiles.store(
+                source.uri, download.path, suffix,
+                download.etag, download.modified
+            )
+            if cached_path is None:
+                result = self._create_source(download.path, source)
+                result.cache = opening.FileCache([download.path])
+            else:
+                result = self._create_cached_source(cached_path, source)
+            
+            if record:
+                # Replaced by the new download
+                caching.DownloadedFiles.release(record.path)
+            
+            results.add_sources([result])
+        
+        results.complete()
     
     
-    def _splice_cb(self, stream, result, state):
-        try:
-            stream.splice_finish(result)
-        except Exception as e:
-            if not state.cancelled:
-                state.results.errors.append(e)
-        else:
-            result = GFileSource(state.files[1], "", parent=state.source)
-            result.cache = opening.FileCache([state.cache_path])
-            state.results.sources.append(result)
-        finally:
-            state.results.complete()
+    @staticmethod
+    def _create_source(path, parent):
+        return GFileSource(Gio.File.new_for_path(path), "", parent=parent)
+    
+    
+    @staticmethod
+    def _create_cached_source(path, parent):
+        """ Creates a source for a file in the download cache, which
+            releases it once it's cleaned up """
+        result = URICacheFallbackOpener._create_source(path, parent)
+        result.cache = opening.DownloadedFileCache(path)
+        return result
 
 
 class URIListSelectionOpener(SelectionOpener):
@@ -413,7 +796,7 @@ class URIListSelectionOpener(SelectionOpener):
     
     def open_selection(self, context, results, selection, source):
         uris = selection.get_uris()
-        results.sources.extend(
+        results.add_sources(
             URISource(an_uri, parent=source) for an_uri in uris)
         # This code is just used to specify a fitting name for the source
         if uris:
@@ -471,7 +854,7 @@ class TextSelectionOpener(SelectionOpener):
         parse_result = urlparse(text)
         if (parse_result.scheme and parse_result.path
                 and (parse_result.netloc or parse_result.scheme == "file")):
-            results.sources.append(URISource(text, parent=source))
+            results.add_sources([URISource(text, parent=source)])
             got_results = True
             file_uri = parse_result.scheme == "file"
         else:
@@ -482,7 +865,7 @@ class TextSelectionOpener(SelectionOpener):
                 # Wildly assuming this is a valid filename
                 # just because it starts with a slash
                 text = "file://" + os_path.normcase(os_path.normcase(text))
-                results.sources.append(URISource(text, parent=source))
+                results.add_sources([URISource(text, parent=source)])
                 got_results = file_uri = True
         
         # Setting source name
@@ -500,8 +883,19 @@ class BuiltInOpeners(extending.ComponentPackage):
     @staticmethod
     def add_on(app):
         components = app.components
+        pixbuf_opener = PixbufOpener()
+        animation_opener = PixbufAnimationFileOpener()
+        
+        # Animations aren't decoded while they download
+        stream_extensions = {
+            an_extension.lstrip(".").lower()
+            for an_extension in pixbuf_opener.extensions
+        } - {
+            an_extension.lstrip(".").lower()
+            for an_extension in animation_opener.extensions
+        }
         uri_guesser = URIOpenerGuesser()
-        uri_guesser.fallback = URICacheFallbackOpener()
+        uri_guesser.fallback = URICacheFallbackOpener(stream_extensions)
         guessers = (
             GFileOpenerGuesser(),
             uri_guesser
@@ -509,12 +903,11 @@ class BuiltInOpeners(extending.ComponentPackage):
         for a_guesser in guessers:
             components.add(OpenerGuesser.CATEGORY, a_guesser)
             
-        pixbuf_opener = PixbufOpener()
-        directory_opener = DirectoryOpener()
+        directory_opener = DirectoryOpener(app)
         source_openers = (
             directory_opener, # Opens directories
             pixbuf_opener, # Opens images
-            PixbufAnimationFileOpener(), # Opens animations
+            animation_opener, # Opens animations
         )
         for an_opener in source_openers:
             components.add(Opener.CATEGORY, an_opener)
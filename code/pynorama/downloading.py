@@ -0,0 +1,433 @@
+""" downloading.py copies remote files into local ones a few at a time """
+
+""" ...and this file is part of Pynorama.
+    
+    Pynorama is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    Pynorama is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with Pynorama. If not, see <http://www.gnu.org/licenses/>. """
+
+from gi.repository import Gio, GLib
+from collections import Counter
+from urllib.parse import urlparse
+import heapq
+import itertools
+import os
+from . import utility
+
+# How many downloads can run at once, in total and from the same host
+DOWNLOAD_LIMIT = 8
+DOWNLOAD_HOST_LIMIT = 2
+# The file attributes used to tell whether a remote file has changed
+VALIDATOR_ATTRIBUTES = ",".join([
+    Gio.FILE_ATTRIBUTE_ETAG_VALUE,
+    Gio.FILE_ATTRIBUTE_TIME_MODIFIED
+])
+
+
+def ReadValidators(info):
+    """ Returns the (etag, modification time) of a file info, either
+        of them None if it isn't known """
+    etag = info.get_attribute_string(Gio.FILE_ATTRIBUTE_ETAG_VALUE) or None
+    if info.has_attribute(Gio.FILE_ATTRIBUTE_TIME_MODIFIED):
+        modified = info.get_attribute_uint64(Gio.FILE_ATTRIBUTE_TIME_MODIFIED)
+    else:
+        modified = None
+    
+    return etag, modified
+
+
+class CopyingStream:
+    """ Wraps a Gio.InputStream, writing what is read from it into a
+        file object. Only has the methods DecodeStream uses. """
+    
+    def __init__(self, stream, output):
+        self.stream = stream
+        self.output = output
+    
+    
+    def read_bytes(self, count, cancellable):
+        chunk = self.stream.read_bytes(count, cancellable)
+        self.output.write(chunk.get_data())
+        return chunk
+    
+    
+    def close(self, cancellable):
+        self.stream.close(cancellable)
+
+
+class Download:
+    """ A download of an URI into a local file, see DownloadService
+    
+    .etag and .modified are the validators of the remote file, once known.
+    If the download was given validators and the remote file still has
+    them it isn't downloaded again and .unchanged is set instead.
+    
+    Streamed downloads have no path, whoever queued them reads the URI
+    themselves once they start, see DownloadService.stream.
+    
+    """
+    
+    def __init__(self, uri, path, callback, args, priority,
+                 etag=None, modified=None, parent_cancellable=None):
+        self.uri = uri
+        self.path = path
+        self.callback = callback
+        self.args = args
+        self.priority = priority
+        self.host = urlparse(uri).netloc
+        self.is_streamed = False
+        
+        self.cancellable = Gio.Cancellable()
+        # Cancelling this through DownloadService.cancel cancels the
+        # download along with every other download given it
+        self.parent_cancellable = parent_cancellable
+        self.started = False
+        self.cancelled = False
+        self.done = False
+        self.error = None
+        
+        self.etag = etag
+        self.modified = modified
+        self.unchanged = False
+    
+    
+    def cancel(self):
+        """ Stops the download, its callback won't be called and
+            whatever is at its path is removed """
+        if not self.done and not self.cancelled:
+            self.cancelled = True
+            self.cancellable.cancel()
+            if not self.started:
+                self.remove_file()
+    
+    
+    def remove_file(self):
+        """ Removes whatever was downloaded so far """
+        if self.path is None:
+            return
+        
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class DownloadService:
+    """ Downloads URIs into local files
+    
+    No more than .limit downloads run at once, and no more than .host_limit
+    from the same host. This keeps opening a lot of URIs from opening as
+    many streams at once, and lets GIO reuse the connections it keeps
+    alive to a host for the downloads queued after it.
+    
+    Queued downloads start in order of priority, lower values first, like
+    GLib sources. Once a download is done its callback is called from the
+    main loop as callback(download, *args). Its .error is set if it failed.
+    
+    Downloads given the etag or modification time of a previous copy ask
+    for the file info first, and only download the file if it changed.
+    
+    Downloads given a Gio.Cancellable can be cancelled all at once
+    with .cancel(), e.g. those of something that isn't wanted anymore.
+    
+    Things that read an URI on their own, e.g. decoding it while it's
+    downloaded, can wait for their turn as well with .stream().
+    
+    The GFiles downloaded from are made by new_file(uri), which is
+    Gio.File.new_for_uri unless something else is given, e.g. by tests.
+    
+    """
+    
+    def __init__(self, limit=DOWNLOAD_LIMIT, host_limit=DOWNLOAD_HOST_LIMIT,
+                 new_file=None):
+        self.limit = limit
+        self.host_limit = host_limit
+        self.new_file = new_file or Gio.File.new_for_uri
+        
+        self._counter = itertools.count()
+        self._running = set()
+        self._host_counts = Counter()
+        # Queued downloads are kept in a (priority, order, download) heap
+        # per host, and the hosts with free slots in a heap by the
+        # (priority, order) of their next download, so starting one
+        # doesn't go through the downloads of busy hosts
+        self._host_queues = {}
+        self._ready_hosts = []
+        # The (priority, order) each host is in ._ready_hosts with.
+        # Entries that don't match it anymore are skipped.
+        self._ready_keys = {}
+    
+    
+    def download(self, uri, path, callback, *args,
+                 priority=GLib.PRIORITY_DEFAULT, etag=None, modified=None,
+                 cancellable=None):
+        """ Queues an URI to be downloaded into a path, replacing whatever
+            is there, and returns a Download """
+        a_download = Download(
+            uri, path, callback, args, priority, etag, modified, cancellable
+        )
+        self._enqueue(a_download)
+        self._start_downloads()
+        return a_download
+    
+    
+    def stream(self, uri, callback, *args,
+               priority=GLib.PRIORITY_DEFAULT, cancellable=None):
+        """ Queues a download that is read by the caller and returns it
+        
+        Once it's its turn callback(download, *args) is called and the
+        download counts against the limits until it's given to .release().
+        
+        """
+        a_download = Download(
+            uri, None, callback, args, priority,
+            parent_cancellable=cancellable
+        )
+        a_download.is_streamed = True
+        self._enqueue(a_download)
+        self._start_downloads()
+        return a_download
+    
+    
+    def release(self, download):
+        """ Ends a streamed download so the next ones can start, or
+            cancels it if it hasn't started yet or isn't streamed """
+        if not download.started or not download.is_streamed:
+            download.cancel()
+        elif not download.done:
+            self._release(download)
+            self._start_downloads()
+    
+    
+    def prioritize(self, download, priority):
+        """ Changes the priority of a download that hasn't started yet """
+        if not download.started and download.priority != priority:
+            download.priority = priority
+            # Queued again, the entry with the old priority is skipped
+            self._enqueue(download)
+            self._start_downloads()
+    
+    
+    def cancel(self, cancellable):
+        """ Cancels the downloads given a cancellable """
+        for a_queue in self._host_queues.values():
+            for a_priority, an_order, a_download in a_queue:
+                if a_download.parent_cancellable is cancellable:
+                    a_download.cancel()
+        
+        for a_download in list(self._running):
+            if a_download.parent_cancellable is cancellable:
+                a_download.cancel()
+    
+    
+    def _enqueue(self, download):
+        a_queue = self._host_queues.setdefault(download.host, [])
+        heapq.heappush(
+            a_queue, (download.priority, next(self._counter), download)
+        )
+        self._queue_host(download.host)
+    
+    
+    def _queue_host(self, host):
+        """ Puts a host in ._ready_hosts by its next download if it has
+            free slots, dropping the entries skipped from its queue """
+        a_queue = self._host_queues.get(host)
+        while a_queue:
+            priority, order, a_download = a_queue[0]
+            if a_download.started or a_download.cancelled \
+               or priority != a_download.priority:
+                heapq.heappop(a_queue)
+            else:
+                break
+        
+        if not a_queue:
+            self._host_queues.pop(host, None)
+            self._ready_keys.pop(host, None)
+            
+        elif self._host_counts[host] >= self.host_limit:
+            self._ready_keys.pop(host, None)
+            
+        else:
+            key = a_queue[0][:2]
+            if self._ready_keys.get(host) != key:
+                self._ready_keys[host] = key
+                heapq.heappush(self._ready_hosts, key + (host,))
+    
+    
+    def _start_downloads(self):
+        started_streams = []
+        while self._ready_hosts and len(self._running) < self.limit:
+            priority, order, host = heapq.heappop(self._ready_hosts)
+            if self._ready_keys.get(host) != (priority, order):
+                continue
+            
+            del self._ready_keys[host]
+            priority, order, a_download = heapq.heappop(
+                self._host_queues[host]
+            )
+            if a_download.cancelled:
+                # Cancelled after its host was queued
+                self._queue_host(host)
+                continue
+            
+            a_download.started = True
+            self._running.add(a_download)
+            self._host_counts[host] += 1
+            self._queue_host(host)
+            if a_download.is_streamed:
+                # Called once the queue is settled
+                started_streams.append(a_download)
+                continue
+            
+            gfile = self.new_file(a_download.uri)
+            if a_download.etag or a_download.modified:
+                gfile.query_info_async(
+                    VALIDATOR_ATTRIBUTES,
+                    Gio.FileQueryInfoFlags.NONE,
+                    a_download.priority,
+                    a_download.cancellable,
+                    self._query_info_cb,
+                    a_download
+                )
+            else:
+                self._read(gfile, a_download)
+        
+        for a_download in started_streams:
+            a_download.callback(a_download, *a_download.args)
+    
+    
+    def _query_info_cb(self, gfile, result, download):
+        try:
+            info = gfile.query_info_finish(result)
+        except GLib.Error as e:
+            self._finish(download, e)
+            return
+        
+        etag, modified = ReadValidators(info)
+        if etag:
+            unchanged = etag == download.etag
+        else:
+            unchanged = modified is not None and modified == download.modified
+        
+        if unchanged:
+            download.unchanged = True
+            self._finish(download, None)
+        else:
+            download.etag, download.modified = etag, modified
+            self._read(gfile, download)
+    
+    
+    def _read(self, gfile, download):
+        gfile.read_async(
+            download.priority,
+            download.cancellable,
+            self._read_cb,
+            download
+        )
+    
+    
+    def _read_cb(self, gfile, result, download):
+        try:
+            input_stream = gfile.read_finish(result)
+        except GLib.Error as e:
+            self._finish(download, e)
+            return
+        
+        if download.etag or download.modified:
+            self._replace(download, input_stream)
+        else:
+            input_stream.query_info_async(
+                VALIDATOR_ATTRIBUTES,
+                download.priority,
+                download.cancellable,
+                self._stream_info_cb,
+                (download, input_stream)
+            )
+    
+    
+    def _stream_info_cb(self, input_stream, result, data):
+        download, input_stream = data
+        try:
+            info = input_stream.query_info_finish(result)
+        except GLib.Error:
+            # Not knowing the validators only means downloading it again
+            pass
+        else:
+            download.etag, download.modified = ReadValidators(info)
+        
+        self._replace(download, input_stream)
+    
+    
+    def _replace(self, download, input_stream):
+        Gio.File.new_for_path(download.path).replace_async(
+            None, False,
+            Gio.FileCreateFlags.REPLACE_DESTINATION,
+            download.priority,
+            download.cancellable,
+            self._replace_cb,
+            (download, input_stream)
+        )
+    
+    
+    def _replace_cb(self, gfile, result, data):
+        download, input_stream = data
+        try:
+            output_stream = gfile.replace_finish(result)
+        except GLib.Error as e:
+            input_stream.close(None)
+            self._finish(download, e)
+            return
+        
+        output_stream.splice_async(
+            input_stream,
+            (Gio.OutputStreamSpliceFlags.CLOSE_SOURCE |
+             Gio.OutputStreamSpliceFlags.CLOSE_TARGET),
+            GLib.PRIORITY_LOW,
+            download.cancellable,
+            self._splice_cb,
+            download
+        )
+    
+    
+    def _splice_cb(self, stream, result, download):
+        try:
+            stream.splice_finish(result)
+        except GLib.Error as e:
+            self._finish(download, e)
+        else:
+            self._finish(download, None)
+    
+    
+    def _finish(self, download, error):
+        download.error = error
+        self._release(download)
+        self._start_downloads()
+        if download.cancelled:
+            download.remove_file()
+        else:
+            download.callback(download, *download.args)
+    
+    
+    def _release(self, download):
+        download.done = True
+        self._running.discard(download)
+        self._host_counts[download.host] -= 1
+        if not self._host_counts[download.host]:
+            del self._host_counts[download.host]
+        
+        self._queue_host(download.host)
+
+# Shared by everything that downloads stuff
+Downloads = DownloadService()
+
+# Reads the streamed downloads of Downloads
+StreamWorkers = utility.WorkerPool(DOWNLOAD_LIMIT)
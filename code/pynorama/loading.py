@@ -18,10 +18,26 @@
     You should have received a copy of the GNU General Public License
     along with Pynorama. If not, see <http://www.gnu.org/licenses/>. """
 
-from gi.repository import Gio, GObject
-from . import utility
+from gi.repository import GdkPixbuf, Gio, GLib, GObject
+from collections import OrderedDict
+from . import caching, utility
+import itertools
+import time
 import weakref
 
+# How many bytes of loaded but unused things are kept by default
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+
+# How many image sources have their metadata read per worker job, and
+# how many milliseconds read metadata waits to be applied with more of it
+METADATA_BATCH_SIZE = 64
+METADATA_DELIVERY_INTERVAL = 250
+# How many metadata jobs run at once. Running jobs aren't preempted, so
+# this is kept under the number of workers to leave some for decoding
+METADATA_JOB_LIMIT = 1
+# How many bytes are read at a time while looking for the size of an image
+HEADER_CHUNK_SIZE = 16 * 1024
+
 class DataError(Exception):
     ''' For exceptions due to the current state of the data loaded '''
     pass
@@ -50,6 +66,8 @@ class Loadable(GObject.Object):
         self.status = Status.UNLOADED
         self.reloadable = True
         self.error = None
+        # Loading is done in order of priority, lower values first
+        self.load_priority = GLib.PRIORITY_DEFAULT
         
         self.__uses = 0
         self.__lists = 0
@@ -69,6 +87,17 @@ class Loadable(GObject.Object):
         raise NotImplementedError
     
     
+    def get_memory_usage(self):
+        """ Returns roughly how many bytes the loaded data is using """
+        return 0
+    
+    
+    def prioritize(self, priority):
+        """ Changes the priority of loading this resource, also if it's
+            already waiting to be loaded """
+        self.load_priority = priority
+    
+    
     def destroy(self):
         """Destroys this resource somehow."""
         self.status = Status.DESTROYED
@@ -148,13 +177,19 @@ class Loadable(GObject.Object):
 
 
 class Memory(GObject.GObject):
-    ''' A very basic memory management thing '''
+    ''' A very basic memory management thing
+    
+    Loaded things that are no longer used can be retained so that they
+    don't have to be loaded again if they are used again soon. They are
+    kept least recently used first and .trim() picks which ones to unload
+    once everything loaded takes more than .budget bytes. '''
     
     __gsignals__ = {
         "thing-enlisted": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
         "thing-requested": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
         "thing-unused": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
         "thing-unlisted": (GObject.SIGNAL_RUN_FIRST, None, (Loadable,)),
+        "prefetch-changed": (GObject.SIGNAL_RUN_FIRST, None, ()),
     }
     
     def __init__(self):
@@ -166,6 +201,114 @@ class Memory(GObject.GObject):
         self.unused_stuff = set()
         self.enlisted_stuff = set()
         self.unlisted_stuff = set()
+        
+        # Things being used right now and loaded things no longer used
+        self.used_stuff = weakref.WeakSet()
+        self.retained_stuff = OrderedDict()
+        
+        # Lists of (thing, priority) pairs of things expected to be used
+        # soon by whoever set them, and the things loaded because of that
+        self.prefetch_hints = {}
+        self.prefetched_stuff = set()
+    
+    
+    budget = GObject.Property(
+        type=GObject.TYPE_INT64, default=DEFAULT_MEMORY_BUDGET,
+        minimum=0, maximum=GLib.MAXINT64
+    )
+    
+    
+    def retain(self, thing):
+        """ Keeps a loaded thing that is no longer used around """
+        self.retained_stuff[thing] = True
+        self.retained_stuff.move_to_end(thing)
+    
+    
+    def release(self, thing):
+        """ Stops retaining or prefetching a thing """
+        self.retained_stuff.pop(thing, None)
+        self.prefetched_stuff.discard(thing)
+    
+    
+    def get_usage(self):
+        """ Returns how many bytes the loaded things use """
+        return sum(
+            a_thing.get_memory_usage()
+            for a_thing in itertools.chain(
+                self.used_stuff, self.retained_stuff, self.prefetched_stuff
+            )
+            if a_thing.is_loaded
+        )
+    
+    
+    def trim(self):
+        """ Stops retaining the least recently used things until everything
+            loaded fits the budget and returns them so they can be unloaded """
+        result = []
+        usage = self.get_usage()
+        while usage > self.budget and self.retained_stuff:
+            a_thing, retained = self.retained_stuff.popitem(last=False)
+            usage -= a_thing.get_memory_usage()
+            result.append(a_thing)
+        
+        return result
+    
+    
+    def set_prefetch(self, owner, hints):
+        """ Sets which things an owner expects to be used soon
+        
+        hints should be (thing, priority) pairs like the ones from
+        AlbumLayout.get_prefetch_hints. An empty list removes them.
+        
+        """
+        if hints:
+            self.prefetch_hints[owner] = list(hints)
+        else:
+            self.prefetch_hints.pop(owner, None)
+        
+        self.emit("prefetch-changed")
+    
+    
+    def get_prefetch(self):
+        """ Returns (thing, priority) pairs of every hinted thing with the
+            lowest priority it was hinted with, lowest first """
+        priorities = {}
+        for some_hints in self.prefetch_hints.values():
+            for a_thing, a_priority in some_hints:
+                if a_thing not in priorities or a_priority < priorities[a_thing]:
+                    priorities[a_thing] = a_priority
+        
+        return sorted(priorities.items(), key=lambda item: item[1])
+    
+    
+    def prefetch(self):
+        """ Picks what to load or unload because of the prefetch hints
+        
+        Returns a list with the (thing, priority) pair that should be loaded
+        next, if anything loaded still fits the budget and nothing else is
+        being prefetched, and a list of things prefetched before that are no
+        longer hinted and should be unloaded.
+        
+        """
+        hints = self.get_prefetch()
+        hinted_stuff = set(a_thing for a_thing, a_priority in hints)
+        dropped_stuff = [
+            a_thing for a_thing in self.prefetched_stuff
+            if a_thing not in hinted_stuff
+        ]
+        self.prefetched_stuff.difference_update(dropped_stuff)
+        
+        wanted = []
+        busy = any(a_thing.is_loading for a_thing in self.prefetched_stuff)
+        if not busy and self.get_usage() < self.budget:
+            for a_thing, a_priority in hints:
+                if a_thing.status == Status.UNLOADED and not a_thing.error \
+                   and a_thing.uses == 0:
+                    self.prefetched_stuff.add(a_thing)
+                    wanted.append((a_thing, a_priority))
+                    break
+        
+        return wanted, dropped_stuff
     
     
     def observe(self, *stuff):
@@ -183,6 +326,13 @@ class Memory(GObject.GObject):
     
     
     def _uses_changed_cb(self, thing, difference):
+        if thing.uses > 0:
+            self.used_stuff.add(thing)
+            self.retained_stuff.pop(thing, None)
+            self.prefetched_stuff.discard(thing)
+        else:
+            self.used_stuff.discard(thing)
+        
         if thing.uses == 1 and difference > 0:
             if thing in self.unused_stuff:
                 self.unused_stuff.remove(thing)
@@ -223,10 +373,168 @@ class ImageMeta():
         self.width = 0 # The width of the image in pixels
         self.height = 0 # The height of the image in pixels
         self.modification_date = None # Modification date
+        # Whether all of the above has been read, rather than e.g.
+        # just the width and height of a preview
+        self.is_complete = False
     
     def get_area(self):
         return self.width * self.height
 
+# Stands in for metadata that hasn't been read yet in sorting functions
+UnknownMeta = ImageMeta()
+UnknownMeta.modification_date = 0
+
+
+def ReadImageSize(gfile, cancellable=None):
+    ''' Returns the width and height of an image file from its header
+    
+    Files that are not native are read only until GdkPixbuf figures out
+    the image size. Returns (0, 0) if it can't be figured out.
+    This blocks, so it should be run in a worker.
+    
+    '''
+    if gfile.is_native():
+        fmt, width, height = GdkPixbuf.Pixbuf.get_file_info(gfile.get_path())
+        if fmt:
+            return width, height
+    
+    sizes = []
+    loader = GdkPixbuf.PixbufLoader()
+    loader.connect(
+        "size-prepared", lambda loader, w, h: sizes.append((w, h))
+    )
+    try:
+        stream = gfile.read(cancellable)
+    except GLib.GError:
+        return 0, 0
+    
+    try:
+        while not sizes:
+            chunk = stream.read_bytes(HEADER_CHUNK_SIZE, cancellable)
+            if not chunk.get_size():
+                break
+            
+            loader.write_bytes(chunk)
+            
+    except GLib.GError:
+        pass
+        
+    finally:
+        stream.close(None)
+        try:
+            loader.close()
+        except GLib.GError:
+            # It's obviously missing most of the image
+            pass
+    
+    return sizes[0] if sizes else (0, 0)
+
+
+class MetadataService(GObject.Object):
+    ''' Reads the metadata of image sources in workers
+    
+    This is so that sorting albums by e.g. image size doesn't read every
+    file from the main loop. Read metadata is set to the sources from the
+    main loop in batches and "metadata-read" is emitted with a list of the
+    sources in each of them. '''
+    
+    __gsignals__ = {
+        "metadata-read": (GObject.SIGNAL_RUN_FIRST, None, [object]),
+    }
+    
+    def __init__(self):
+        GObject.Object.__init__(self)
+        
+        self._queued = OrderedDict()
+        self._reading = set()
+        self._read = []
+        self._job_count = 0
+        self._delivery_id = None
+    
+    
+    @property
+    def is_busy(self):
+        ''' Whether there is metadata queued or being read '''
+        return bool(self._queued or self._reading or self._read)
+    
+    
+    def request(self, source):
+        ''' Queues the metadata of a source to be read '''
+        if source not in self._queued and source not in self._reading:
+            self._queued[source] = True
+            self._start_jobs()
+    
+    
+    def _start_jobs(self):
+        while self._queued and self._job_count < METADATA_JOB_LIMIT:
+            batch = []
+            while self._queued and len(batch) < METADATA_BATCH_SIZE:
+                a_source, queued = self._queued.popitem(last=False)
+                batch.append(a_source)
+            
+            self._reading.update(batch)
+            self._job_count += 1
+            utility.Workers.run(
+                self._read_batch, batch,
+                callback=self._read_batch_cb, priority=GLib.PRIORITY_LOW
+            )
+    
+    
+    @staticmethod
+    def _read_batch(batch):
+        result = []
+        for a_source in batch:
+            try:
+                metadata = a_source.read_metadata()
+            except Exception:
+                metadata = None
+            
+            result.append((a_source, metadata))
+        
+        caching.MetadataRecords.commit()
+        return result
+    
+    
+    def _read_batch_cb(self, job):
+        self._job_count -= 1
+        self._read.extend(job.result or [])
+        self._start_jobs()
+        
+        if self._delivery_id is None:
+            self._delivery_id = GLib.timeout_add(
+                METADATA_DELIVERY_INTERVAL, self._deliver
+            )
+    
+    
+    def _deliver(self):
+        self._delivery_id = None
+        read, self._read = self._read, []
+        
+        sources = []
+        for a_source, metadata in read:
+            self._reading.discard(a_source)
+            if metadata is None:
+                # Not trying that again
+                metadata = ImageMeta()
+                metadata.modification_date = 0
+                metadata.is_complete = True
+            
+            if a_source.metadata:
+                # Whatever was known about the source might be more accurate
+                metadata.width = a_source.metadata.width or metadata.width
+                metadata.height = a_source.metadata.height or metadata.height
+            
+            a_source.metadata = metadata
+            sources.append(a_source)
+        
+        if sources:
+            self.emit("metadata-read", sources)
+        
+        return False
+
+# Shared by everything that needs metadata without blocking
+Metadata = MetadataService()
+
 
 class ImageSource(Loadable):
     """ Represents an image  """
@@ -236,6 +544,10 @@ class ImageSource(Loadable):
         # starts using and then stops using a source.
         "new-frame": (GObject.SIGNAL_RUN_FIRST, None, [object]),
         "lost-frame": (GObject.SIGNAL_RUN_LAST, None, [object]),
+        # "data-changed" is emitted when the data of a loaded source
+        # changes without it being reloaded, e.g. a higher resolution
+        # version of it replacing a reduced one.
+        "data-changed": (GObject.SIGNAL_RUN_FIRST, None, []),
     }
     
     def __init__(self, file_source=None):
@@ -247,6 +559,16 @@ class ImageSource(Loadable):
         self.animation = None
         self.metadata = None
         self.file_source = file_source
+        
+        # A (view size, rotation, zoom mode) tuple describing how this image
+        # is expected to be fitted in a view. Loaders may use it to decode
+        # only as many pixels as can actually be displayed.
+        self.display_hint = None
+        # Whether the loaded data is smaller than the actual image
+        self.is_reduced = False
+        # Whether there is something to display while loading, "data-changed"
+        # is emitted when a preview becomes available
+        self.has_preview = False
         if(file_source):
             self.name = self.file_source.get_name()
             self.fullname = self.file_source.get_fullname()
@@ -287,6 +609,12 @@ class ImageSource(Loadable):
         self.uses -= 1
     
     
+    @property
+    def is_displayable(self):
+        """ Whether it's loaded or there is at least a preview of it """
+        return self.is_loaded or self.has_preview
+    
+    
     def get_metadata(self):
         if not self.metadata:
             self.load_metadata()
@@ -294,6 +622,28 @@ class ImageSource(Loadable):
         return self.metadata
     
     
+    def peek_metadata(self):
+        """ Returns the metadata if it has been read completely, or queues
+            it to be read in a worker and returns UnknownMeta otherwise """
+        if self.metadata and self.metadata.is_complete:
+            return self.metadata
+        
+        Metadata.request(self)
+        return UnknownMeta
+    
+    
+    def read_metadata(self):
+        """ Returns new ImageMeta without loading the image or touching
+            anything else, or None if it can't be done.
+            This is run in a worker """
+        return None
+    
+    
+    def request_full_resolution(self):
+        """ Loads the image at its actual size if it was loaded reduced """
+        pass
+    
+    
     def create_frame(self):
         """ Returns a new ImageFrame for rendering this ImageSource"""
         raise NotImplementedError
@@ -310,6 +660,40 @@ class GFileImageSource(ImageSource):
         self.gfile = gfile = file_source.gfile
     
     
+    def read_metadata(self):
+        metadata = ImageMeta()
+        try:
+            file_info = self.gfile.query_info(
+                "standard::size,time::modified", 0, None
+            )
+        except GLib.GError:
+            file_info = None
+        
+        if file_info and file_info.has_attribute("time::modified"):
+            metadata.data_size = file_info.get_size()
+            metadata.modification_date = float(
+                file_info.get_attribute_uint64("time::modified")
+            )
+            # The file info is all it takes to find a record of the size
+            uri = self.gfile.get_uri()
+            key = uri, metadata.modification_date, metadata.data_size
+            image_size = caching.MetadataRecords.lookup(*key)
+            if image_size is None:
+                image_size = ReadImageSize(self.gfile)
+                if all(image_size):
+                    caching.MetadataRecords.store(*key, image_size)
+        else:
+            if file_info:
+                metadata.data_size = file_info.get_size()
+            
+            metadata.modification_date = float(time.time())
+            image_size = ReadImageSize(self.gfile)
+        
+        metadata.width, metadata.height = image_size
+        metadata.is_complete = True
+        return metadata
+    
+    
     def copy_to_clipboard(self, clipboard):
         """ Copies itself into the clipboard """
         
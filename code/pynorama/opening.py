@@ -27,10 +27,11 @@
 
 import os
 import shutil
+import time
 from gettext import ngettext as N_
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
 from gi.repository import Gdk, Gio, GLib, GObject, Gtk
-from . import utility, notifying
+from . import caching, downloading, utility, notifying
 from .extending import Opener, SelectionOpener
 
 logger = notifying.Logger("opening")
@@ -42,6 +43,12 @@ STANDARD_GFILE_INFO = (
 )
 STANDARD_GFILE_INFO_STRING = ",".join(STANDARD_GFILE_INFO)
 PARENT_OPENER_CATEGORY = "parent-opener"
+# How many milliseconds of each main loop iteration can be spent opening
+OPENING_TIME_BUDGET = 8
+# How many file info queries can be running at once
+FILE_INFO_QUERY_LIMIT = 16
+# How many sources OpeningSession.add_sources_gradually adds per idle call
+OPENING_CHUNK_SIZE = 1000
 
 class OpeningHandler(GObject.Object):
     """ Provides methods to open things """
@@ -58,6 +65,10 @@ class OpeningHandler(GObject.Object):
     def open_file_source(self, context, session, source):
         """ Tries to open a FileSource with an appropriate FileOpener """
         results = OpeningResults()
+        # The results are set before opening so that the session
+        # gets any partial results the opener hands over
+        session.set_source_results(source, results)
+        
         guessed_opener = self.guess_source_opener(context, session, source)
         if guessed_opener:
             results.opener = guessed_opener
@@ -69,8 +80,6 @@ class OpeningHandler(GObject.Object):
                 
         else:
             results.complete()
-        
-        session.set_source_results(source, results)
     
     
     def open_selection(self, context, selection_data, source):
@@ -209,6 +218,9 @@ class OpeningHandler(GObject.Object):
         context.connect("open-next::gfile", self._open_next_gfile_cb)
         context.connect("open-next::uri", self._open_next_uri_cb)
         if album is not None:
+            context.connect(
+                "new-session", self._standard_new_session_cb, album
+            )
             context.connect(
                 "finished-session",
                 self._standard_session_finished_cb,
@@ -242,11 +254,52 @@ class OpeningHandler(GObject.Object):
     warning_image_count_threshold = GObject.Property(type=int, default=0)
     
     
+    def _standard_new_session_cb(self, context, session, album):
+        session.connect(
+            "partial", self._standard_partial_results_cb, context, album
+        )
+    
+    
+    def _standard_partial_results_cb(self, session, source, images, sources,
+                                     context, album):
+        """Standard handling for results a session got before finishing.
+        
+        Images are added to the album right away and sources start being
+        opened if that doesn't depend on how the session ends.
+        
+        """
+        if session.cancelled:
+            return
+        
+        if images:
+            self._add_images(images, album)
+        
+        if sources and self._continues_partially(session):
+            for a_source in sources:
+                a_source.link_parent()
+            
+            self._continue_opening(context, session, [(source, sources)])
+    
+    
+    def _continues_partially(self, session):
+        """Whether sources are opened as soon as a session gets them.
+        
+        Otherwise whether to open them at all depends on how many images
+        the session got, and that is only known once it's finished.
+        
+        """
+        return (
+            not session.search_siblings
+            and session.depth < self.warning_depth_threshold
+        )
+    
+    
     def _standard_session_finished_cb(self, context, session, album):
         """Standard handling for finished opening sessions"""
         
-        # Total sources, images and errors of this session
-        ( sources, images, errors
+        # Total sources, images and errors of this session, and
+        # the images that weren't added to the album as partial results
+        ( sources, images, new_images, errors
         ) = self._gather_session_results(context, session)
         
         logger.debug(
@@ -261,11 +314,8 @@ class OpeningHandler(GObject.Object):
             for a_source in some_sources:
                 a_source.link_parent()
         
-        for an_image in images:
-            an_image.link_source()
-        
-        self.app.memory.observe_stuff(images)
-        album.extend(images)
+        if new_images:
+            self._add_images(new_images, album)
         
         # TODO: New URIs handling, error handling, no opener found handling
         if sources:
@@ -284,8 +334,16 @@ class OpeningHandler(GObject.Object):
                 self._continue_opening(context, session, sources)
     
     
+    def _add_images(self, images, album):
+        for an_image in images:
+            an_image.link_source()
+        
+        self.app.memory.observe_stuff(images)
+        album.extend(images)
+    
+    
     def _gather_session_results(self, context, session):
-        sources, images, errors = [], [], []
+        sources, images, new_images, errors = [], [], [], []
         
         if session.search_siblings:
             logger.debug("Depth %s sibling search..." % session.depth)
@@ -299,6 +357,12 @@ class OpeningHandler(GObject.Object):
                 if not some_results:
                     continue
                 
+                # The images are shown right away, their siblings are
+                # added around them once they're found
+                images.extend(some_results.images)
+                new_images.extend(
+                    some_results.images[some_results.flushed_images:]
+                )
                 errors.extend(some_results.errors)
                 if some_results.sources:
                     sources.append((a_key, some_results.sources))
@@ -328,6 +392,8 @@ class OpeningHandler(GObject.Object):
                     reversed(self.app.components[PARENT_OPENER_CATEGORY])
                 )
                 siblings_session = context.get_new_session()
+                siblings_session.for_siblings_of_session = session
+                session.search_siblings_session = siblings_session
                 siblings_session.add_openers(parent_openers)
                 siblings_session.add_sources(
                     map(GFileSource, parent_files)
@@ -336,14 +402,25 @@ class OpeningHandler(GObject.Object):
         else: # not session.search_siblings
             # TODO: Remove files in sessions created to search sibling
             # files of another session that were opened in that first session
+            continued_partially = self._continues_partially(session)
             for key, some_results in session.results.items():
                 if some_results:
                     images.extend(some_results.images)
+                    new_images.extend(
+                        some_results.images[some_results.flushed_images:]
+                    )
                     errors.extend(some_results.errors)
-                    if some_results.sources:
-                        sources.append((key, some_results.sources))
+                    some_sources = some_results.sources
+                    if continued_partially:
+                        # These are already being opened
+                        some_sources = some_sources[
+                            some_results.flushed_sources:
+                        ]
+                    
+                    if some_sources:
+                        sources.append((key, some_sources))
         
-        return sources, images, errors
+        return sources, images, new_images, errors
     
     
     def _reverse_link_images(self, images):
@@ -400,21 +477,55 @@ class OpeningHandler(GObject.Object):
     def _added_gfile_cb(self, session, sources, context):
         """ Queries file info of files added to a session and starts
             opening them if any of the files already has its information """
+        if session.cancelled:
+            return
+        
+        # Files opened already by the session whose siblings are
+        # being searched aren't opened again
+        opened_uris = self._get_opened_sibling_uris(session)
+        if opened_uris:
+            kept_sources = []
+            for a_source in sources:
+                if a_source.gfile.get_uri() in opened_uris:
+                    if a_source.is_linked:
+                        a_source.unlink_parent()
+                else:
+                    kept_sources.append(a_source)
+            
+            sources[:] = kept_sources
         
-        sources_to_enqueue = []
+        sources_to_enqueue, sources_to_query = [], []
         for a_source in sources:
-            if a_source.fill_missing_info(STANDARD_GFILE_INFO):
-                sources_to_enqueue.append(a_source)
+            if a_source.get_missing_info(STANDARD_GFILE_INFO):
+                sources_to_query.append(a_source)
             else:
-                # XXX: too lazy to look up better way to disconnect on callback
-                signal_id_list = []
-                signal_id_list.append(a_source.connect(
-                    "loaded-file-info",
-                    self._loaded_file_info_cb,
-                    session, context, signal_id_list
-                ))
-                
+                sources_to_enqueue.append(a_source)
+        
         context.enqueue_sources(session, sources_to_enqueue)
+        if sources_to_query:
+            FileInfos.query(
+                sources_to_query, STANDARD_GFILE_INFO,
+                self._queried_file_info_cb, session, context,
+                cancellable=context.cancellable
+            )
+    
+    
+    @staticmethod
+    def _get_opened_sibling_uris(session):
+        """ Returns the URIs of the files with images in the session whose
+            siblings a session or its ancestors are opening, if any """
+        while session.for_siblings_of_session is None:
+            session = session.parent_session
+            if session is None:
+                return None
+        
+        return {
+            a_source.gfile.get_uri()
+            for a_source, some_results
+            in session.for_siblings_of_session.results.items()
+            if a_source.kind == GFileSource.KIND
+            and some_results and some_results.images
+        }
     
     
     def _added_uri_cb(self, session, sources, context):
@@ -422,38 +533,49 @@ class OpeningHandler(GObject.Object):
         Removes local URIs(file://) and adds them back as GFiles instead.
         
         """
-        new_sources = []
-        for i in range(len(sources)):
-            j = i - len(new_sources)
-            an_uri_source = sources[j]
-            if an_uri_source.uri.lower().startswith("file:"):
-                # Probably, all local URIs start with file: and then
-                # some slashes... probably...
-                # FIXME: This won't copy .name and .pathname because there is
-                # no way to figure out whether it was custom set or not
-                gfile = Gio.File.new_for_uri(an_uri_source.uri)
-                parent = an_uri_source.parent
-                
-                a_new_source = GFileSource(gfile, parent=parent)
-                
-                # Switch links
-                if an_uri_source.is_linked:
-                    a_new_source.link_parent()
-                an_uri_source.unlink_parent()
-                
-                new_sources.append(a_new_source)
-                del sources[j]
+        if session.cancelled:
+            return
+        
+        new_sources, remote_sources = [], []
+        for an_uri_source in sources:
+            # Probably, all local URIs start with file: and then
+            # some slashes... probably...
+            if an_uri_source.uri[:5].lower() != "file:":
+                remote_sources.append(an_uri_source)
+                continue
+            
+            # FIXME: This won't copy .name and .pathname because there is
+            # no way to figure out whether it was custom set or not
+            gfile = Gio.File.new_for_uri(an_uri_source.uri)
+            parent = an_uri_source.parent
+            
+            a_new_source = GFileSource(gfile, parent=parent)
+            
+            # Switch links
+            if an_uri_source.is_linked:
+                a_new_source.link_parent()
+            an_uri_source.unlink_parent()
+            
+            new_sources.append(a_new_source)
         
+        # Local URIs are taken out of the session in one go
+        sources[:] = remote_sources
         session.add_sources(new_sources)
         
         # Enqueue remaining non-local URIs to be opened
         context.enqueue_sources(session, sources)
     
     
-    def _loaded_file_info_cb(self, source, session, context, signal_id_list):
-        """ Enqueues a file that has got its file info to be opened """
-        context.enqueue_sources(session, (source,))
-        source.disconnect(signal_id_list[0])
+    def _queried_file_info_cb(self, sources, failures, session, context):
+        """ Enqueues files that have got their file info to be opened """
+        context.enqueue_sources(session, sources)
+        
+        # Files whose info can't be queried can't be opened either
+        for a_source, an_error in failures:
+            results = OpeningResults()
+            session.set_source_results(a_source, results)
+            results.errors.append(an_error)
+            results.complete()
     
     
     def _open_next_gfile_cb(self, context, session, source):
@@ -526,10 +648,19 @@ class OpeningContext(GObject.Object):
         self.opening_queue = deque()
         
         self.open_next = utility.IdlyMethod(self.open_next)
+        self.open_next.priority = self.priority
         
         self.connect("notify::keep-open", self._notify_keep_open_cb)
+        self.connect("notify::priority", self._notify_priority_cb)
+        self.connect("notify::focus-source", self._notify_focus_source_cb)
         
         self.cache_directory = app.cache_directory.name
+        self.cancellable = Gio.Cancellable()
+        # Cancelled by .cancel(), openers should pass it to whatever I/O
+        # they do so that it stops when what they open isn't wanted
+        self._downloads = {}
+        # The source each download queued by .download() is for, until
+        # it's done, so their priorities can follow .focus_source
     
     # Whether to keep the context "unfinished" even if the criteria to
     # finish it is true
@@ -539,6 +670,16 @@ class OpeningContext(GObject.Object):
         return self._keep_open_counter > 0
     
     
+    # How many milliseconds each idle call of .open_next can spend
+    # opening queued items before letting the main loop go on
+    time_budget = GObject.Property(type=int, default=OPENING_TIME_BUDGET)
+    # The priority of those idle calls
+    priority = GObject.Property(type=int, default=GLib.PRIORITY_DEFAULT_IDLE)
+    # The source the user wants to see first, if any. Its slower
+    # steps, e.g. downloads, are done ahead of the other sources
+    focus_source = GObject.Property(type=object)
+    
+    
     def hold_open(self):
         """
         Forces the context not to emit the "finished" signal when the criteria
@@ -575,10 +716,57 @@ class OpeningContext(GObject.Object):
         return new_session
     
     
+    def cancel(self):
+        """ Stops opening everything opened so far
+        
+        Queued files are dropped, the I/O using .cancellable is cancelled,
+        file info queries and downloads for it are dropped, and the
+        sessions opened so far are marked as cancelled so that results
+        they get afterwards are ignored. The context itself can still be
+        used, with a new .cancellable, to open something else instead.
+        
+        """
+        assert not self.finished
+        
+        self.cancellable.cancel()
+        FileInfos.cancel(self.cancellable)
+        downloading.Downloads.cancel(self.cancellable)
+        self._downloads.clear()
+        self.cancellable = Gio.Cancellable()
+        
+        self.opening_queue.clear()
+        for a_session in self.open_sessions:
+            a_session.cancel()
+        
+        # Cancelled sessions don't keep the context from finishing
+        self.open_sessions.clear()
+    
+    
+    def download(self, source, path, callback, *args,
+                 etag=None, modified=None):
+        """ Queues the URI of a source to be downloaded into a path
+        
+        Works like downloading.Downloads.download, except that the
+        download is cancelled with .cancel(), and it's done ahead of
+        the others while the source is the .focus_source.
+        
+        """
+        a_download = downloading.Downloads.download(
+            source.uri, path, self._downloaded_cb, source, callback, args,
+            priority=self._get_download_priority(source),
+            cancellable=self.cancellable, etag=etag, modified=modified
+        )
+        self._downloads[a_download] = source
+        return a_download
+    
+    
     def enqueue_sources(self, session, sources):
         """ Queues files to be opened """
         assert not self.finished
         
+        if session.cancelled:
+            return
+        
         self.opening_queue.extend((session, a_source) for a_source in sources)
         self.open_next.queue()
     
@@ -603,17 +791,25 @@ class OpeningContext(GObject.Object):
     
     def open_next(self):
         """
-        Emits an "open-next" signal for a file that has its missing info
+        Emits "open-next" signals for queued files that have their missing
+        info until the queue is empty or .time_budget runs out, in which
+        case it queues itself to go on from the next idle call
         
         """
         
-        try:
-            session, next_item = self.opening_queue.popleft()
-        except IndexError: # There are no files in the queue!
+        queue = self.opening_queue
+        if not queue: # There are no files in the queue!
             return False
         
-        self.emit("open-next::" + next_item.kind, session, next_item)
-        self.open_next.queue()
+        deadline = time.monotonic() + self.time_budget / 1000
+        while queue:
+            session, next_item = queue.popleft()
+            self.emit("open-next::" + next_item.kind, session, next_item)
+            if time.monotonic() >= deadline:
+                break
+        
+        if queue:
+            self.open_next.queue()
         
         return True
     
@@ -624,6 +820,9 @@ class OpeningContext(GObject.Object):
         itself is finished.
         
         """
+        if session.cancelled:
+            return
+        
         self.open_sessions.remove(session)
         self.emit("finished-session", session)
         if not self.open_sessions:
@@ -633,6 +832,30 @@ class OpeningContext(GObject.Object):
                 self.finish()
     
     
+    def _notify_priority_cb(self, *etc):
+        self.open_next.priority = self.priority
+    
+    
+    def _notify_focus_source_cb(self, *etc):
+        for a_download, a_source in self._downloads.items():
+            downloading.Downloads.prioritize(
+                a_download, self._get_download_priority(a_source)
+            )
+    
+    
+    def _get_download_priority(self, source):
+        focus_source = self.focus_source
+        if focus_source is not None and source.resembles(focus_source):
+            return GLib.PRIORITY_HIGH
+        else:
+            return GLib.PRIORITY_DEFAULT
+    
+    
+    def _downloaded_cb(self, download, source, callback, args):
+        self._downloads.pop(download, None)
+        callback(download, *args)
+    
+    
     def _notify_keep_open_cb(self, *etc):
         """
         Emits the "finished" signal if the context was finished while it was
@@ -659,6 +882,11 @@ class OpeningSession(GObject.Object):
     __gsignals__ = {
         "added" : (GObject.SIGNAL_DETAILED, None, [object]),
         "opened" : (GObject.SIGNAL_DETAILED, None, [object, object]),
+        # Emitted with a source and the images and sources its results
+        # got before they are complete
+        "partial" : (
+            GObject.SIGNAL_RUN_FIRST, None, [object, object, object]
+        ),
         "finished" : (GObject.SIGNAL_ACTION, None, []),
     }
     def __init__(self, parent, parent_source):
@@ -682,6 +910,8 @@ class OpeningSession(GObject.Object):
             self.depth = len(ancestry)
             
         self.finished = False
+        # Whether its context was cancelled while it was being opened
+        self.cancelled = False
         
         self.search_siblings = False
         self.search_siblings_session = None
@@ -689,9 +919,16 @@ class OpeningSession(GObject.Object):
         
         self.results = {}
         self._results_completion_signals = {}
+        self._results_partial_signals = {}
         self.incomplete_results = set()
         self.sources_missing_results = set()
         self.sources, self.openers = [], []
+        # Sources waiting to be added by .add_sources_gradually
+        self._pending_sources = deque()
+        self._pending_chunk_size = OPENING_CHUNK_SIZE
+        self._add_pending_sources = utility.IdlyMethod(
+            self._add_pending_sources
+        )
     
     
     def finish(self):
@@ -726,6 +963,40 @@ class OpeningSession(GObject.Object):
                 self.sources_missing_results.update(some_sources)
     
     
+    def cancel(self):
+        """ Marks the session as cancelled and drops the sources
+            .add_sources_gradually had yet to add, see OpeningContext """
+        self.cancelled = True
+        self._pending_sources.clear()
+        self._add_pending_sources.cancel_queue()
+    
+    
+    def add_sources_gradually(self, sources, chunk_size=OPENING_CHUNK_SIZE):
+        """ Like .add_sources, but only the first chunk_size sources are
+            added right away and the rest a chunk per idle call so that
+            adding huge lists of sources doesn't freeze the interface.
+            The session isn't finished before they are all added. """
+        assert not self.finished
+        
+        self._pending_sources.extend(sources)
+        self._pending_chunk_size = chunk_size
+        self._add_pending_sources()
+    
+    
+    def _add_pending_sources(self):
+        if self.cancelled:
+            return
+        
+        pending = self._pending_sources
+        chunk_size = min(self._pending_chunk_size, len(pending))
+        self.add_sources(pending.popleft() for i in range(chunk_size))
+        if pending:
+            self._add_pending_sources.queue()
+        elif not self.finished:
+            # The sources added before may all have been opened already
+            self._check_finished()
+    
+    
     def add_clipboards(self, clipboards):
         """ Adds Gtk.Clipboard objects to be opened in this session """
         assert not self.finished
@@ -753,6 +1024,14 @@ class OpeningSession(GObject.Object):
             self._results_completion_signals[results] = results.connect(
                 "completed", self._results_completed_cb, source
             )
+            self._results_partial_signals[results] = results.connect(
+                "partial", self._results_partial_cb, source
+            )
+    
+    
+    def _results_partial_cb(self, results, images, sources, source):
+        """ Handle for output that opening results get incrementally """
+        self.emit("partial", source, images, sources)
     
     
     def _results_completed_cb(self, results, source):
@@ -760,18 +1039,21 @@ class OpeningSession(GObject.Object):
         self.incomplete_results.remove(results)
         # breaking reference cycle created by signal handlers
         results.disconnect(self._results_completion_signals.pop(results))
+        results.disconnect(self._results_partial_signals.pop(results))
         self.emit("opened::" + source.kind, results, source)
         self._check_finished()
     
     
     def _check_finished(self):
-        if not (self.incomplete_results or self.sources_missing_results):
+        if not (self.incomplete_results or self.sources_missing_results
+                or self._pending_sources):
             self.finish()
 
 
 class OpeningResults(GObject.Object):
     """ A structure for the results of trying to open something """
     __gsignals__ = {
+       "partial": (GObject.SIGNAL_RUN_FIRST, None, [object, object]),
        "completed": (GObject.SIGNAL_ACTION, None, [])
     }
     
@@ -790,6 +1072,10 @@ class OpeningResults(GObject.Object):
         
         self.errors = []
         # A list of exceptions that have occurred while opening something
+        
+        self.flushed_images = self.flushed_sources = 0
+        # How many of the .images and .sources have been handed over
+        # by .flush()
     
     
     def __iadd__(self, other):
@@ -812,6 +1098,38 @@ class OpeningResults(GObject.Object):
         return not(self.sources or self.images or self.errors)
     
     
+    def add_images(self, images):
+        """ Adds images to these results and hands them over right away """
+        self.images.extend(images)
+        self.flush()
+    
+    
+    def add_sources(self, sources):
+        """ Adds sources to these results and hands them over right away """
+        self.sources.extend(sources)
+        self.flush()
+    
+    
+    def flush(self):
+        """
+        Emits a "partial" signal with the images and sources added since
+        the last flush so that they can be used before these results are
+        complete.
+        
+        Openers that output a lot or take long to complete should flush
+        their results every now and then.
+        
+        """
+        assert not self.completed
+        
+        new_images = self.images[self.flushed_images:]
+        new_sources = self.sources[self.flushed_sources:]
+        if new_images or new_sources:
+            self.flushed_images = len(self.images)
+            self.flushed_sources = len(self.sources)
+            self.emit("partial", new_images, new_sources)
+    
+    
     def complete(self):
         """
         Emits a "completed" signal on this object and sets its .completed
@@ -864,6 +1182,24 @@ class FileCache(Cache):
             self.cached = False
 
 
+class DownloadedFileCache(Cache):
+    """
+    Releases a file handed out by caching.DownloadedFiles on cleanup,
+    so it can be evicted once nothing uses it.
+    
+    """
+    def __init__(self, path):
+        Cache.__init__(self)
+        self.path = path
+        self.cached = True
+    
+    
+    def uncache(self):
+        if self.cached:
+            caching.DownloadedFiles.release(self.path)
+            self.cached = False
+
+
 class FileSource:
     def __init__(self, kind, name, parent=None, pathname=None):
         self.kind = kind
@@ -1051,7 +1387,8 @@ class GFileSource(GObject.Object, FileSource):
             self.missing_info = {"standard::display-name",}
     
     
-    def fill_missing_info(self, info_keys):
+    def get_missing_info(self, info_keys):
+        """ Returns a set of the info_keys missing from .info """
         if self.info is None:
             missing_info = set(info_keys)
         else:
@@ -1062,52 +1399,35 @@ class GFileSource(GObject.Object, FileSource):
         
         if self.missing_info:
             missing_info.update(self.missing_info)
-            self.missing_info = None
         
-        if missing_info:
-            # There are attributes missing, so we are going to query them
+        return missing_info
+    
+    
+    def fill_missing_info(self, info_keys):
+        """ Returns .info if it has all the info_keys, otherwise queues
+            them to be queried, emits "loaded-file-info" once that's done
+            and returns None """
+        if self.get_missing_info(info_keys):
             if not self.being_queried:
-                self.gfile.query_info_async(
-                    ",".join(missing_info), # comma separated attributes
-                    Gio.FileQueryInfoFlags.NONE,
-                    GLib.PRIORITY_LOW,
-                    None,
-                    self._queried_missing_info_cb,
-                    None
-                )
-                self.being_queried = False
-            else:
-                # Store missing info so it can be queried later
-                self.missing_info = missing_info
-                
+                FileInfos.query([self], info_keys, self._filled_info_cb)
+            
             return None
         else:
             return self.info
     
     
-    def _queried_missing_info_cb(self, gfile, result, *etc):
-        self.being_queried = False
-        
-        try:
-            new_info = gfile.query_info_finish(result)
-        except GLib.Error:
-            raise Exception
-        
-        # Put new info into cache somehow
-        if self.info is None:
-            self.info = stored_info = new_info
-        else:
-            new_info.copy_into(self.info)
+    def set_queried_info(self, new_info):
+        """ Replaces .info with info queried by a FileInfoService """
+        self.info = new_info
+        self.missing_info = None
         
         if self._fill_missing_name:
             self.name = self.info.get_display_name()
             self._fill_missing_name = False
-        
-        # If this returns not None we have all the info, otherwise
-        # a new query will be created for that missing info
-        if self.missing_info:
-            self.fill_missing_info(self.missing_info)
-        else:
+    
+    
+    def _filled_info_cb(self, sources, failures):
+        if sources:
             self.emit("loaded-file-info")
     
     
@@ -1123,6 +1443,163 @@ class GFileSource(GObject.Object, FileSource):
         return False
 
 
+class FileInfoService:
+    """ Queries the missing file info of GFileSources a few at a time
+    
+    No more than .limit queries run at once so that opening thousands of
+    files doesn't flood GIO, and sources of the same file share a query.
+    Sources whose info has been queried are handed to the callback of
+    their request in batches, from the main loop, as
+    callback(sources, failures, *args) where failures is a list of
+    (source, error) tuples for those whose query failed.
+    
+    Requests given a Gio.Cancellable can be dropped with .cancel(), and
+    queries nothing else is waiting for are cancelled along with them.
+    
+    """
+    
+    def __init__(self, limit=FILE_INFO_QUERY_LIMIT):
+        self.limit = limit
+        
+        self._queued = OrderedDict()
+        self._running = {}
+        self._requests_done = []
+        self._deliver = utility.IdlyMethod(self._deliver)
+    
+    
+    def query(self, sources, info_keys, callback, *args, cancellable=None):
+        """ Queues the file info of sources to be queried """
+        request = FileInfoService.Request(
+            info_keys, callback, args, cancellable
+        )
+        for a_source in sources:
+            self._add(a_source, request)
+        
+        self._start_queries()
+    
+    
+    def cancel(self, cancellable):
+        """ Drops the requests made with a cancellable """
+        for some_queries in (self._queued, self._running):
+            for an_uri, a_query in list(some_queries.items()):
+                waiting = []
+                for a_source, a_request in a_query.waiting:
+                    if a_request.cancellable is cancellable:
+                        a_source.being_queried = False
+                    else:
+                        waiting.append((a_source, a_request))
+                
+                a_query.waiting = waiting
+                if not waiting:
+                    del some_queries[an_uri]
+                    a_query.cancellable.cancel()
+        
+        self._requests_done = [
+            a_request for a_request in self._requests_done
+            if a_request.cancellable is not cancellable
+        ]
+        self._start_queries()
+    
+    
+    class Request:
+        def __init__(self, info_keys, callback, args, cancellable):
+            self.info_keys = info_keys
+            self.callback = callback
+            self.args = args
+            self.cancellable = cancellable
+            
+            self.sources, self.failures = [], []
+            self.is_done = False
+    
+    
+    class Query:
+        def __init__(self, gfile):
+            self.gfile = gfile
+            self.info_keys = set()
+            # The keys that were actually queried, once the query starts
+            self.requested_keys = frozenset()
+            self.waiting = []
+            self.cancellable = Gio.Cancellable()
+    
+    
+    def _add(self, source, request):
+        uri = source.gfile.get_uri()
+        a_query = self._running.get(uri) or self._queued.get(uri)
+        if a_query is None:
+            a_query = self._queued[uri] = FileInfoService.Query(source.gfile)
+        
+        # Whatever is known already is queried again so the new info
+        # can simply replace the old info
+        if source.info is not None:
+            a_query.info_keys.update(source.info.list_attributes(None))
+        
+        a_query.info_keys.update(source.get_missing_info(request.info_keys))
+        a_query.waiting.append((source, request))
+        source.being_queried = True
+    
+    
+    def _start_queries(self):
+        while self._queued and len(self._running) < self.limit:
+            uri, a_query = self._queued.popitem(last=False)
+            self._running[uri] = a_query
+            a_query.requested_keys = frozenset(a_query.info_keys)
+            a_query.gfile.query_info_async(
+                ",".join(a_query.requested_keys), # comma separated attributes
+                Gio.FileQueryInfoFlags.NONE,
+                GLib.PRIORITY_LOW,
+                a_query.cancellable,
+                self._queried_info_cb,
+                (uri, a_query)
+            )
+    
+    
+    def _queried_info_cb(self, gfile, result, data):
+        uri, a_query = data
+        if self._running.get(uri) is a_query:
+            del self._running[uri]
+        
+        try:
+            new_info = gfile.query_info_finish(result)
+        except GLib.Error as e:
+            new_info, error = None, e
+        
+        for a_source, a_request in a_query.waiting:
+            a_source.being_queried = False
+            if new_info is None:
+                a_request.failures.append((a_source, error))
+            else:
+                a_source.set_queried_info(
+                    new_info.dup() if len(a_query.waiting) > 1 else new_info
+                )
+                missing_info = a_source.get_missing_info(a_request.info_keys)
+                if missing_info - a_query.requested_keys:
+                    # It was added while the query was running
+                    # and it needs more than what was queried
+                    self._add(a_source, a_request)
+                    continue
+                
+                a_request.sources.append(a_source)
+            
+            if not a_request.is_done:
+                a_request.is_done = True
+                self._requests_done.append(a_request)
+        
+        self._start_queries()
+        self._deliver.queue()
+    
+    
+    def _deliver(self):
+        requests_done, self._requests_done = self._requests_done, []
+        for a_request in requests_done:
+            a_request.is_done = False
+            sources, a_request.sources = a_request.sources, []
+            failures, a_request.failures = a_request.failures, []
+            a_request.callback(sources, failures, *a_request.args)
+
+# Shared by everything that queries file info for opening
+FileInfos = FileInfoService()
+
+
 class URISource(FileSource):
     KIND ="uri"
     
@@ -19,8 +19,8 @@
 
 
 from gi.repository import GLib, GObject
-from collections import MutableSequence
-from . import utility
+from collections import Counter, MutableSequence
+from . import loading, utility
 
 class Album(GObject.Object):
     ''' It organizes images '''
@@ -38,8 +38,27 @@ class Album(GObject.Object):
         self.connect("notify::autosort", self.__queue_autosort)
         self.connect("notify::comparer", self.__queue_autosort)
         
+        # Images are sorted again as their metadata is read in workers.
+        # The service outlives albums, so this is disconnected by .clean()
+        self.__metadata_signal_id = loading.Metadata.connect(
+            "metadata-read", self.__metadata_read_cb
+        )
+        
         self._store = []
+        # How many times each image is in the store, for quickly telling
+        # whether the sources whose metadata was read are in this album
+        self.__image_counts = Counter()
         self.__autosort_signal_id = None
+    
+    def clean(self):
+        ''' Stops the album from following the metadata service '''
+        if self.__metadata_signal_id is not None:
+            loading.Metadata.disconnect(self.__metadata_signal_id)
+            self.__metadata_signal_id = None
+        
+        if self.__autosort_signal_id:
+            GLib.source_remove(self.__autosort_signal_id)
+            self.__autosort_signal_id = None
         
     # --- Mutable sequence interface down this line ---#
     def __len__(self):
@@ -49,6 +68,14 @@ class Album(GObject.Object):
         return self._store[item]
         
     def __setitem__(self, item, value):
+        if isinstance(item, slice):
+            value = list(value)
+            self.__forget(self._store[item])
+            self.__image_counts.update(value)
+        else:
+            self.__forget([self._store[item]])
+            self.__image_counts[value] += 1
+        
         self._store[item] = value
         
     def __delitem__(self, item):
@@ -63,16 +90,19 @@ class Album(GObject.Object):
                     
             removed_images = self._store[item]
             del self._store[item]
+            self.__forget(removed_images)
             
             for i in range(len(removed_indices)):
                 image, index = removed_images[i], removed_indices[i]
                 self.emit("image-removed", image, index)
         else:
             image = self._store.pop(item)
+            self.__forget([image])
             self.emit("image-removed", image, item)
     
     def insert(self, index, image):
         self._store.insert(index, image)
+        self.__image_counts[image] += 1
         self.emit("image-added", image, index)
         self.__queue_autosort()
     
@@ -150,6 +180,20 @@ class Album(GObject.Object):
             self.sort()
         
         return False
+    
+    def __forget(self, images):
+        image_counts = self.__image_counts
+        for an_image in images:
+            image_counts[an_image] -= 1
+            if image_counts[an_image] <= 0:
+                del image_counts[an_image]
+    
+    def __metadata_read_cb(self, service, sources):
+        if self.autosort and \
+           self.comparer in SortingKeys.ByMetadata and \
+           not self.__autosort_signal_id and \
+           any(a_source in self.__image_counts for a_source in sources):
+            self.__queue_autosort()
         
 class SortingKeys:
     ''' Contains functions to get keys in images for sorting them '''
@@ -161,25 +205,32 @@ class SortingKeys:
         return image.fullname.lower()
             
     def ByFileSize(image):
-        return image.get_metadata().data_size
+        return image.peek_metadata().data_size
         
     def ByFileDate(image):
-        return image.get_metadata().modification_date
+        return image.peek_metadata().modification_date
         
     def ByImageSize(image):
-        return image.get_metadata().get_area()
+        return image.peek_metadata().get_area()
         
     def ByImageWidth(image):
-        return image.get_metadata().width
+        return image.peek_metadata().width
         
     def ByImageHeight(image):
-        return image.get_metadata().height
+        return image.peek_metadata().height
         
     Enum = [
         ByName, ByCharacters,
         ByFileSize, ByFileDate,
         ByImageSize, ByImageWidth, ByImageHeight
     ]
+    
+    # These keys read metadata in workers, so images are
+    # sorted by them again once it has been read
+    ByMetadata = [
+        ByFileSize, ByFileDate,
+        ByImageSize, ByImageWidth, ByImageHeight
+    ]
 
 
 class AlbumViewLayout(GObject.Object):
@@ -230,6 +281,13 @@ class AlbumViewLayout(GObject.Object):
         self.__old_layout.go_previous(self)
     
     
+    def get_prefetch_hints(self):
+        if self.__old_layout and self.album:
+            return self.__old_layout.get_prefetch_hints(self)
+        else:
+            return []
+    
+    
     def clean(self):
         if not self.__is_clean:
             self.__old_layout.clean(self)
@@ -258,6 +316,12 @@ class AlbumViewLayout(GObject.Object):
 
 class AlbumLayout:
     ''' Places images from an album into a view '''
+    
+    # How many images after and before the focused one are worth loading
+    # before they are actually shown
+    prefetch_forward = 2
+    prefetch_backwards = 1
+    
     def __init__(self):
         self.__subscribers = set()
         
@@ -314,6 +378,18 @@ class AlbumLayout:
         previous_image = avl.album.previous(focus)
         avl.go_image(previous_image)        
         
+    def get_prefetch_hints(self, avl):
+        ''' Returns (image, priority) pairs of images likely to be shown
+            soon, sooner first, with GLib like priorities for loading them '''
+        focus = avl.focus_image
+        if focus is None:
+            return []
+            
+        return PrefetchHints(
+            avl.album, focus, focus,
+            self.prefetch_forward, self.prefetch_backwards
+        )
+        
 
     def start(self, avl):
         ''' Set any initial variables in an AlbumViewLayout '''
@@ -328,6 +404,29 @@ class AlbumLayout:
         pass
 
 
+def PrefetchHints(album, last, first, forward, backwards):
+    ''' Returns (image, priority) pairs for "forward" images after "last"
+        and "backwards" images before "first" in an album, alternating
+        between both sides from the closest to the farthest '''
+    try:
+        after = album.around(last, forward, 0)
+        before = album.around(first, 0, backwards)
+    except ValueError:
+        # Not in the album anymore
+        return []
+    
+    result = []
+    seen = set([first, last])
+    for distance in range(max(len(after), len(before))):
+        for side in after, before:
+            if distance < len(side) and side[distance] not in seen:
+                seen.add(side[distance])
+                priority = GLib.PRIORITY_LOW + distance
+                result.append((side[distance], priority))
+    
+    return result
+
+
 class LayoutDirection:
     Left = "left"
     Right = "right"
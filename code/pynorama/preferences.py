@@ -169,16 +169,33 @@ class ViewPreferencesTabProxy(Gtk.Box):
             tooltip_text=zoom_tooltip
         )
         
+        # Memory budget
+        label = _("Memory for images (MiB)")
+        memory_tooltip = _(
+            "Images no longer shown are kept in memory until they take" +
+            " more than this so going back to them is quicker"
+        )
+        memory_budget_label = Gtk.Label(label)
+        memory_budget_entry, memory_budget_adjust = widgets.SpinAdjustment(
+            512, 0, 64 * 1024, 64, 256, align=True
+        )
+        utility.SetProperties(
+            memory_budget_label, memory_budget_entry,
+            tooltip_text=memory_tooltip
+        )
+        
         # packing widgets
         widgets.Grid(
             (spin_effect_label, spin_effect_entry),
             (zoom_effect_label, zoom_effect_entry),
+            (memory_budget_label, memory_budget_entry),
             align_first=True, expand_first=True,
             grid=grid, start_row=1
         )
         utility.Bind(dialog.app,
             ("spin-effect", spin_effect_adjust, "value"),
             ("zoom-effect", zoom_effect_adjust, "value"),
+            ("memory-budget", memory_budget_adjust, "value"),
             bidirectional=True, synchronize=True
         )
         
@@ -19,7 +19,11 @@
 from gi.repository import Gdk, GLib, GObject
 from collections import namedtuple
 import cairo
+import itertools
 import math
+import os
+import queue
+import threading
 
 class Enum:
     """Convenience class to make enums.
@@ -96,6 +100,112 @@ class IdlyMethod:
         return self.is_queued
 
 
+class WorkerJob:
+    """ A function call scheduled in a WorkerPool """
+    def __init__(self, function, args, callback, priority):
+        self.function = function
+        self.args = args
+        self.callback = callback
+        self.priority = priority
+        
+        self.cancelled = False
+        self.started = False
+        self.done = False
+        self.result = None
+        self.error = None
+
+    
+    def cancel(self):
+        """ Prevents the job from running if it hasn't started yet and its
+            callback from being called if it hasn't been called yet """
+        self.cancelled = True
+
+    
+    def finish(self):
+        """ Returns the result of the job or raises its exception """
+        if self.error is not None:
+            raise self.error
+        
+        return self.result
+
+
+class WorkerPool:
+    """ Runs functions in worker threads and hands their results
+        back to the GLib main loop.
+        
+        Jobs with a lower priority value run first, like GLib sources.
+        The functions run must not touch any widgets. """
+    
+    def __init__(self, size=None):
+        self.size = size or max(2, min(4, os.cpu_count() or 1))
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    
+    def run(self, function, *args,
+            callback=None, priority=GLib.PRIORITY_DEFAULT):
+        """ Calls function(*args) in a worker thread
+        
+        If a callback is set it's called from the main loop with the job
+        as the only argument once the function returns or raises.
+        Returns a WorkerJob that can be used to cancel the call.
+        
+        """
+        job = WorkerJob(function, args, callback, priority)
+        self._queue.put((priority, next(self._counter), job))
+        
+        with self._lock:
+            if len(self._threads) < self.size:
+                a_thread = threading.Thread(
+                    target=self._work, name="pynorama-worker", daemon=True
+                )
+                self._threads.append(a_thread)
+                a_thread.start()
+        
+        return job
+
+    
+    def reprioritize(self, job, priority):
+        """ Changes the priority of a job that hasn't started yet """
+        if not job.started and not job.cancelled and job.priority != priority:
+            job.priority = priority
+            # The job is queued again, whichever copy comes out last is
+            # skipped since the job has been started by then
+            self._queue.put((priority, next(self._counter), job))
+
+    
+    def _work(self):
+        while True:
+            priority, order, job = self._queue.get()
+            with self._lock:
+                if job.cancelled or job.started:
+                    continue
+                
+                job.started = True
+            
+            try:
+                job.result = job.function(*job.args)
+            except Exception as e:
+                job.error = e
+            
+            job.done = True
+            if job.callback is not None:
+                GLib.idle_add(self._deliver, job, priority=job.priority)
+
+    
+    def _deliver(self, job):
+        if not job.cancelled:
+            job.callback(job)
+        
+        return False
+
+
+# Shared by everything that needs to do some heavy lifting
+Workers = WorkerPool()
+
+
 #~ 2D aritmetic utilities ~#
 class Point(namedtuple("Point", ("x", "y"))):
     def __add__(a, b):
@@ -448,6 +558,110 @@ def SurfaceFromPixbuf(pixbuf):
     return surface
 
 
+class SurfacePyramid:
+    """ Lazily built copies of a cairo surface halved in size again and again
+    
+    These are used to draw surfaces minified without resampling every pixel
+    of the original surface every time. Levels are built in a worker and
+    the ready_callback is called from the main loop when new ones are ready.
+    
+    """
+    
+    # Levels are not built below this size
+    MINIMUM_SIZE = 16
+    
+    def __init__(self, surface, ready_callback=None):
+        self.levels = [surface]
+        self.ready_callback = ready_callback
+        self._job = None
+    
+    
+    def get_surface(self, zoom):
+        """ Returns the smallest surface whose scale is at least zoom, or the
+            closest to it that has already been built otherwise """
+        
+        wanted_level = 0
+        if zoom < 1:
+            wanted_level = int(math.floor(math.log(1 / zoom, 2)))
+        
+        if wanted_level >= len(self.levels):
+            last = self.levels[-1]
+            can_shrink = min(last.get_width(), last.get_height()) // 2 \
+                         >= self.MINIMUM_SIZE
+            if can_shrink and self._job is None:
+                self._job = Workers.run(
+                    self._build, last, wanted_level - len(self.levels) + 1,
+                    callback=self._built, priority=GLib.PRIORITY_LOW
+                )
+            
+            wanted_level = len(self.levels) - 1
+            
+        return self.levels[wanted_level]
+    
+    
+    def get_memory_usage(self):
+        """ Returns how many bytes the levels other than the original use """
+        return sum(
+            a_level.get_stride() * a_level.get_height()
+            for a_level in self.levels[1:]
+        )
+    
+    
+    def cancel(self):
+        """ Cancels building any levels """
+        if self._job:
+            self._job.cancel()
+            self._job = None
+    
+    
+    def _build(self, surface, count):
+        result = []
+        for i in range(count):
+            width, height = surface.get_width(), surface.get_height()
+            if min(width, height) // 2 < self.MINIMUM_SIZE:
+                break
+            
+            surface = HalveSurface(surface)
+            result.append(surface)
+        
+        return result
+    
+    
+    def _built(self, job):
+        self._job = None
+        try:
+            new_levels = job.finish()
+        except Exception:
+            return
+        
+        if new_levels:
+            self.levels.extend(new_levels)
+            if self.ready_callback:
+                self.ready_callback()
+
+
+def HalveSurface(surface):
+    """ Returns a new surface with half the size of surface """
+    width = max(1, surface.get_width() // 2)
+    height = max(1, surface.get_height() // 2)
+    
+    result = cairo.ImageSurface(surface.get_format(), width, height)
+    cr = cairo.Context(result)
+    cr.scale(width / surface.get_width(), height / surface.get_height())
+    cr.set_source_surface(surface, 0, 0)
+    # At exactly half size bilinear filtering averages every 2×2 pixels
+    cr.get_source().set_filter(cairo.FILTER_BILINEAR)
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    cr.paint()
+    
+    return result
+
+
+def SurfaceMemoryUsage(surface):
+    """ Returns how many bytes of pixel data a cairo image surface uses """
+    return surface.get_stride() * surface.get_height()
+
+
 def PixbufFromSurface(surface):
     """Returns a Gdk.Pixbuf from a cairo surface"""
     return Gdk.pixbuf_get_from_surface(
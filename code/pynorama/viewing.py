@@ -26,6 +26,47 @@ class ZoomMode:
     MatchHeight = 2
     FitContent = 3
 
+
+def ZoomForSize(view_size, size, mode):
+    """ Gets a zoom for fitting a size in a view size based on a zoom mode """
+    w, h = view_size
+    sw, sh = size
+    
+    if mode == ZoomMode.MatchWidth:
+        # Match view and size width
+        size_side = sw
+        view_side = w
+    
+    elif mode == ZoomMode.MatchHeight:
+        # Match view and size height
+        size_side = sh
+        view_side = h
+    else:
+        wr, hr = w / sw, h / sh
+        
+        if mode == ZoomMode.FitContent:
+            # Fit size inside view
+            if wr < hr:
+                size_side = sw
+                view_side = w
+            else:
+                size_side = sh
+                view_side = h
+                                    
+        elif mode == ZoomMode.FillView:
+            # Overflow size in view in only one side
+            if wr > hr:
+                size_side = sw
+                view_side = w
+            else:
+                size_side = sh
+                view_side = h
+        
+        else:
+            size_side = view_side = 1
+            
+    return view_side / size_side
+
 # Quite possibly the least badly designed class in the whole program.
 class ImageView(Gtk.DrawingArea, Gtk.Scrollable):
     """
@@ -181,43 +222,7 @@ class ImageView(Gtk.DrawingArea, Gtk.Scrollable):
     
     def zoom_for_size(self, size, mode):
         """ Gets a zoom for a size based on a zoom mode """
-        w, h = self.get_widget_size()
-        sw, sh = size
-        
-        if mode == ZoomMode.MatchWidth:
-            # Match view and size width
-            size_side = sw
-            view_side = w
-        
-        elif mode == ZoomMode.MatchHeight:
-            # Match view and size height
-            size_side = sh
-            view_side = h
-        else:
-            wr, hr = w / sw, h / sh
-            
-            if mode == ZoomMode.FitContent:
-                # Fit size inside view
-                if wr < hr:
-                    size_side = sw
-                    view_side = w
-                else:
-                    size_side = sh
-                    view_side = h
-                                        
-            elif mode == ZoomMode.FillView:
-                # Overflow size in view in only one side
-                if wr > hr:
-                    size_side = sw
-                    view_side = w
-                else:
-                    size_side = sh
-                    view_side = h
-            
-            else:
-                size_side = view_size = 1
-                
-        return view_side / size_side
+        return ZoomForSize(self.get_widget_size(), size, mode)
     
     
     def adjust_to_pin(self, pin):
@@ -977,6 +982,9 @@ class ImageFrame(BaseFrame):
         self.__source_loaded_signal = source.connect(
             "finished-loading", self.check_source
         )
+        self.__source_changed_signal = source.connect(
+            "data-changed", self._source_data_changed_cb
+        )
         self.check_source()
         
         
@@ -994,6 +1002,7 @@ class ImageFrame(BaseFrame):
     def do_destroy(self):
         if self.source:
             self.source.disconnect(self.__source_loaded_signal)
+            self.source.disconnect(self.__source_changed_signal)
             self.source.emit("lost-frame", self)
     
     
@@ -1001,16 +1010,21 @@ class ImageFrame(BaseFrame):
         self.check_source()
     
     
+    def _source_data_changed_cb(self, *whatever):
+        self.check_source()
+        self.emit("changed")
+    
+    
     def check_source(self, *whatever):
         """Checks the .source status
         
-        If .source is loaded, .rectangle will be set using the
+        If .source is displayable, .rectangle will be set using the
         .source metadata and .draw_image_source will be used
         for rendering. If something is wrong with the .source
         then a missing error image will be used instead.
         
         """
-        source_ok = self.source.is_loaded
+        source_ok = self.source.is_displayable
         
         if source_ok:
             self.draw = self.draw_image_source
@@ -1049,25 +1063,61 @@ class ImageFrame(BaseFrame):
 
 
 class SurfaceSourceImageFrame(ImageFrame):
-    """ImageFrame for ImageSources exposing a .surface attribute"""
+    """ImageFrame for ImageSources exposing a .surface attribute
+    
+    The .surface may be smaller than the image metadata size if the source
+    .is_reduced, in which case it's stretched over the frame and the source
+    is asked for its full resolution when it's magnified past its size.
+    
+    If the source also has a .pyramid, a utility.SurfacePyramid of its
+    .surface, minified images are drawn from its levels instead.
+    
+    """
     
     def __init__(self, *args, **kwargs):
         ImageFrame.__init__(self, *args, **kwargs)
         
         self._surface_pattern = None
+        self._pattern_surface = None
+        self._pattern_scale = 1
     
     
     def draw_image_source(self, cr, drawstate):
         """Renders an ImageSource with a .surface into the frame"""
         
-        if self._surface_pattern is None:
-            rectangle = self.rectangle
-            self._surface_pattern = self.render_surface(
-                cr, drawstate, self.source.surface,
-                (rectangle.left, rectangle.top)
-            )
-        else:
-            self.render_pattern(cr, drawstate, self._surface_pattern)
+        source = self.source
+        surface = source.surface
+        rectangle = self.rectangle
+        
+        zoom = drawstate.magnification * rectangle.width / surface.get_width()
+        if zoom < 1 and source.pyramid:
+            surface = source.pyramid.get_surface(zoom)
+        
+        if self._pattern_surface is not surface:
+            scale = rectangle.width / surface.get_width()
+            pattern = cairo.SurfacePattern(surface)
+            pattern.set_matrix(cairo.Matrix(
+                xx=1 / scale, yy=1 / scale,
+                x0=-rectangle.left / scale, y0=-rectangle.top / scale
+            ))
+            
+            self._surface_pattern = pattern
+            self._pattern_surface = surface
+            self._pattern_scale = scale
+        
+        pattern = self._surface_pattern
+        cr.set_source(pattern)
+        
+        # Setting the interpolation filter based on the surface zoom
+        zoom = drawstate.magnification * self._pattern_scale
+        if zoom != 1:
+            interp_filter = drawstate.get_filter_for_magnification(zoom)
+            pattern.set_filter(interp_filter)
+        
+        cr.paint()
+        
+        if zoom > 1 and source.is_reduced:
+            source.request_full_resolution()
 
 
 class AnimatedPixbufSourceFrame(ImageFrame):
@@ -0,0 +1,288 @@
+""" test_downloading.py checks the limits and priorities of DownloadService
+    against stand-ins for remote files. Run it from the code directory with
+    python -m unittest discover tests """
+
+""" ...and this file is part of Pynorama.
+    
+    Pynorama is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    Pynorama is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with Pynorama. If not, see <http://www.gnu.org/licenses/>. """
+
+import gi
+gi.require_version("Gdk", "3.0")
+gi.require_version("GdkPixbuf", "2.0")
+from gi.repository import Gio, GLib
+from collections import Counter
+from urllib.parse import urlparse
+import os
+import tempfile
+import unittest
+from pynorama import downloading
+
+# How many milliseconds remote files take to answer, so downloads overlap
+RESPONSE_DELAY = 200
+# Seconds after which a test gives up waiting for its downloads
+TEST_TIMEOUT = 30
+
+
+class FakeServer:
+    """ Answers the reads of RemoteFiles with local files holding the path
+        of their URI, and records how many reads were waiting at once """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.etag = "current"
+        self.started = []
+        self.answered = 0
+        self.running = 0
+        self.most_running = 0
+        self.host_running = Counter()
+        self.most_host_running = Counter()
+    
+    
+    def new_file(self, uri):
+        return RemoteFile(self, uri)
+    
+    
+    def start(self, uri):
+        host = urlparse(uri).netloc
+        self.started.append(urlparse(uri).path)
+        self.running += 1
+        self.host_running[host] += 1
+        self.most_running = max(self.most_running, self.running)
+        self.most_host_running[host] = max(
+            self.most_host_running[host], self.host_running[host]
+        )
+    
+    
+    def answer(self, uri):
+        """ Returns the path of a local file with what is at an URI """
+        self.running -= 1
+        self.host_running[urlparse(uri).netloc] -= 1
+        self.answered += 1
+        path = os.path.join(self.directory, "body{}".format(self.answered))
+        with open(path, "w") as a_file:
+            a_file.write(urlparse(uri).path)
+        
+        return path
+
+
+class RemoteFile:
+    """ Stands in for the Gio.File of a remote URI. Only has the methods
+        DownloadService uses, which answer after RESPONSE_DELAY. """
+    
+    def __init__(self, server, uri):
+        self.server = server
+        self.uri = uri
+    
+    
+    def query_info_async(self, attributes, flags, priority, cancellable,
+                         callback, data):
+        GLib.timeout_add(RESPONSE_DELAY, self._answer_cb, callback, data)
+    
+    
+    def query_info_finish(self, result):
+        info = Gio.FileInfo()
+        info.set_attribute_string(
+            Gio.FILE_ATTRIBUTE_ETAG_VALUE, self.server.etag
+        )
+        return info
+    
+    
+    def read_async(self, priority, cancellable, callback, data):
+        self.server.start(self.uri)
+        GLib.timeout_add(
+            RESPONSE_DELAY, self._answer_cb, callback, data, True
+        )
+    
+    
+    def read_finish(self, result):
+        return Gio.File.new_for_path(result).read(None)
+    
+    
+    def _answer_cb(self, callback, data, is_read=False):
+        result = self.server.answer(self.uri) if is_read else None
+        callback(self, result, data)
+        return False
+
+
+class DownloadServiceTest(unittest.TestCase):
+    """ Runs downloads from a FakeServer in the main loop """
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = FakeServer(self.directory.name)
+        self.loop = GLib.MainLoop()
+        self.finished = []
+        self.pending = 0
+    
+    
+    def tearDown(self):
+        self.directory.cleanup()
+    
+    
+    def get_service(self, **kwargs):
+        return downloading.DownloadService(
+            new_file=self.server.new_file, **kwargs
+        )
+    
+    
+    @staticmethod
+    def get_uri(host, name):
+        return "http://{}/{}".format(host, name)
+    
+    
+    def download(self, service, uri, **kwargs):
+        path = os.path.join(
+            self.directory.name, "download{}".format(self.pending)
+        )
+        self.pending += 1
+        return service.download(uri, path, self._downloaded_cb, **kwargs)
+    
+    
+    def run_downloads(self):
+        """ Runs the main loop until every download is over """
+        timed_out = []
+        def timed_out_cb():
+            timed_out.append(True)
+            self.loop.quit()
+            return False
+        
+        timeout_id = GLib.timeout_add_seconds(TEST_TIMEOUT, timed_out_cb)
+        if self.pending:
+            self.loop.run()
+        
+        self.assertFalse(timed_out, "The downloads took too long")
+        GLib.source_remove(timeout_id)
+        for a_download in self.finished:
+            self.assertIsNone(a_download.error)
+            if a_download.unchanged:
+                continue
+            
+            with open(a_download.path, "r") as a_file:
+                self.assertEqual(a_file.read(), urlparse(a_download.uri).path)
+    
+    
+    def test_limit(self):
+        """ No more than .limit downloads run at once """
+        service = self.get_service(limit=3, host_limit=10)
+        for i in range(8):
+            self.download(service, self.get_uri("a.example", i))
+        
+        self.run_downloads()
+        self.assertEqual(len(self.finished), 8)
+        self.assertEqual(self.server.most_running, 3)
+    
+    
+    def test_host_limit(self):
+        """ No more than .host_limit downloads from a host run at once,
+            while downloads from other hosts still run """
+        service = self.get_service(limit=8, host_limit=2)
+        hosts = "a.example", "b.example"
+        for i in range(4):
+            for a_host in hosts:
+                self.download(service, self.get_uri(a_host, a_host + str(i)))
+        
+        self.run_downloads()
+        self.assertEqual(len(self.finished), 8)
+        for a_host in hosts:
+            self.assertEqual(self.server.most_host_running[a_host], 2)
+        
+        self.assertGreater(self.server.most_running, 2)
+    
+    
+    def test_priority(self):
+        """ Queued downloads start by priority, lower values first """
+        service = self.get_service(limit=1)
+        # This one starts right away and holds the only slot
+        self.download(service, self.get_uri("a.example", "first"))
+        self.download(
+            service, self.get_uri("a.example", "low"),
+            priority=GLib.PRIORITY_LOW
+        )
+        self.download(service, self.get_uri("b.example", "default"))
+        self.download(
+            service, self.get_uri("a.example", "high"),
+            priority=GLib.PRIORITY_HIGH
+        )
+        prioritized = self.download(
+            service, self.get_uri("b.example", "prioritized"),
+            priority=GLib.PRIORITY_LOW
+        )
+        service.prioritize(prioritized, GLib.PRIORITY_HIGH - 100)
+        
+        self.run_downloads()
+        self.assertEqual(
+            self.server.started,
+            ["/first", "/prioritized", "/high", "/default", "/low"]
+        )
+    
+    
+    def test_busy_host(self):
+        """ Downloads from a host at its limit wait without holding up
+            the downloads from other hosts queued after them """
+        service = self.get_service(limit=4, host_limit=1)
+        for i in range(3):
+            self.download(
+                service, self.get_uri("a.example", i),
+                priority=GLib.PRIORITY_HIGH
+            )
+        
+        self.download(service, self.get_uri("b.example", "other"))
+        self.run_downloads()
+        self.assertEqual(self.server.started[:2], ["/0", "/other"])
+        self.assertEqual(self.server.most_host_running["a.example"], 1)
+    
+    
+    def test_unchanged(self):
+        """ Downloads given the validators of the remote file only
+            ask for its info, the others download it again """
+        service = self.get_service()
+        unchanged = self.download(
+            service, self.get_uri("a.example", "unchanged"), etag="current"
+        )
+        changed = self.download(
+            service, self.get_uri("a.example", "changed"), etag="outdated"
+        )
+        
+        self.run_downloads()
+        self.assertTrue(unchanged.unchanged)
+        self.assertFalse(changed.unchanged)
+        self.assertEqual(changed.etag, "current")
+        self.assertEqual(self.server.started, ["/changed"])
+    
+    
+    def test_stream(self):
+        """ Streamed downloads count against the limits until released """
+        service = self.get_service(limit=1)
+        streams = []
+        first = service.stream(
+            self.get_uri("a.example", "stream"), streams.append
+        )
+        self.download(service, self.get_uri("a.example", "after"))
+        self.assertEqual(streams, [first])
+        self.assertEqual(self.server.started, [])
+        
+        service.release(first)
+        self.run_downloads()
+        self.assertEqual(self.server.started, ["/after"])
+    
+    
+    def _downloaded_cb(self, download):
+        self.finished.append(download)
+        self.pending -= 1
+        if not self.pending:
+            self.loop.quit()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+""" test_extractors.py checks reading the images inside archives.
+    Run it from the code directory with python -m unittest discover tests """
+
+""" ...and this file is part of Pynorama.
+    
+    Pynorama is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    
+    Pynorama is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+    
+    You should have received a copy of the GNU General Public License
+    along with Pynorama. If not, see <http://www.gnu.org/licenses/>. """
+
+import gi
+gi.require_version("Gdk", "3.0")
+gi.require_version("GdkPixbuf", "2.0")
+gi.require_version("Gtk", "3.0")
+from unittest import mock
+import gzip
+import io
+import os
+import random
+import tarfile
+import tempfile
+import unittest
+from pynorama.components import extractors
+
+# How many images are in the test archive and how large each of them is
+MEMBER_COUNT = 24
+MEMBER_SIZE = 50 * 1000
+# The tar file is compressed in gzip members of about this many bytes
+GZIP_MEMBER_SIZE = 300 * 1000
+
+
+class TarOpenerTest(unittest.TestCase):
+    """ Indexes a tar.gz file made of several gzip members, with seek
+        points close enough together that some of them are dropped """
+    
+    def setUp(self):
+        # Random data doesn't compress, so offsets move on quickly
+        randomness = random.Random(0)
+        self.contents = {}
+        tar_data = io.BytesIO()
+        with tarfile.open(fileobj=tar_data, mode="w") as a_tarfile:
+            for i in range(MEMBER_COUNT):
+                name = "img{}.png".format(i)
+                data = bytes(
+                    randomness.getrandbits(8) for j in range(MEMBER_SIZE)
+                )
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                a_tarfile.addfile(info, io.BytesIO(data))
+                self.contents[name] = data
+        
+        tar_data = tar_data.getvalue()
+        descriptor, self.path = tempfile.mkstemp(suffix=".tar.gz")
+        with os.fdopen(descriptor, "wb") as a_file:
+            for start in range(0, len(tar_data), GZIP_MEMBER_SIZE):
+                a_file.write(gzip.compress(
+                    tar_data[start:start + GZIP_MEMBER_SIZE]
+                ))
+    
+    
+    def tearDown(self):
+        os.remove(self.path)
+    
+    
+    @mock.patch.object(extractors, "SEEK_POINT_SPACING", 100 * 1000)
+    @mock.patch.object(extractors, "SEEK_POINT_LIMIT", 8)
+    def test_read_members(self):
+        """ Every member reads back right from the seek points """
+        archive, members = extractors.TarOpener()._index(self.path)
+        self.assertIsInstance(archive, extractors.GzipTarArchive)
+        self.assertEqual(len(members), MEMBER_COUNT)
+        
+        seek_points = archive.seek_points
+        self.assertGreater(len(seek_points), 1)
+        self.assertLessEqual(len(seek_points), 8)
+        self.assertEqual(
+            archive._uncompressed_offsets,
+            [a_point[1] for a_point in seek_points]
+        )
+        
+        # Backwards too, so that no reading depends on the previous one
+        for a_member, a_name, a_size, a_date in reversed(members):
+            self.assertEqual(archive.read(a_member), self.contents[a_name])
+
+
+if __name__ == "__main__":
+    unittest.main()